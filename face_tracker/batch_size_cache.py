@@ -0,0 +1,59 @@
+import json
+import os
+from pathlib import Path
+from typing import Union
+
+from face_detector import FaceDetector
+
+
+class BatchSizeCache:
+    """Largest batch sizes supported by the face detector for each setup, stored as a JSON file."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.batch_sizes = {}
+        self.load()
+
+    def load(self):
+        if self.path.exists():
+            with self.path.open('r', encoding='utf8') as fp:
+                self.batch_sizes = json.load(fp)
+
+    def save(self):
+        # Write to a temporary file first so concurrent runs never read a partial file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with tmp_path.open('w', encoding='utf8') as fp:
+            json.dump(self.batch_sizes, fp, indent=2, sort_keys=True)
+        tmp_path.replace(self.path)
+
+    @staticmethod
+    def get_key(width: int, height: int, detector: FaceDetector) -> str:
+        face_size_range = 'none' if detector.face_size_range is None else \
+            ','.join(f'{fraction:.6f}' for fraction in detector.face_size_range)
+        return f'{width}x{height}|scale={detector.scale:.6f}|min_face_size={detector.min_face_size}|' \
+               f'max_face_size={detector.max_face_size}|face_size_range={face_size_range}|' \
+               f'backend={detector.backend_name}|mtcnn_model={detector.mtcnn_model}|' \
+               f'device={detector.get_device_name()}'
+
+    def get(self, width: int, height: int, detector: FaceDetector) -> Union[int, None]:
+        entry = self.batch_sizes.get(self.get_key(width, height, detector))
+        return entry['batch_size'] if isinstance(entry, dict) else entry
+
+    def is_capped(self, width: int, height: int, detector: FaceDetector) -> bool:
+        """Whether the stored batch size is the maximum of the run that probed it."""
+        entry = self.batch_sizes.get(self.get_key(width, height, detector))
+        # Batch sizes stored as plain numbers predate the flag and may be capped
+        return not isinstance(entry, dict) or entry['capped']
+
+    def set(self, width: int, height: int, detector: FaceDetector, batch_size: int, capped: bool = False):
+        # Merge with the batch sizes stored by other runs
+        self.load()
+        self.batch_sizes[self.get_key(width, height, detector)] = {'batch_size': int(batch_size), 'capped': capped}
+        self.save()
+
+    def shrink(self, width: int, height: int, detector: FaceDetector, batch_size: int):
+        """Stores `batch_size` if it is smaller than the stored one, after a memory error."""
+        stored_batch_size = self.get(width, height, detector)
+        if stored_batch_size is None or batch_size < stored_batch_size:
+            self.set(width, height, detector, batch_size)
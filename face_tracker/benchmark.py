@@ -0,0 +1,523 @@
+import json
+import time
+import tempfile
+import itertools
+import multiprocessing
+from pathlib import Path
+from typing import List
+
+import argh
+import cv2
+import torch
+
+import numpy as np
+
+from detections import Detections, get_face_size_range, load_detections
+from face_detector import MTCNN_MODELS, FaceDetector
+from main import detect_faces_on_video
+from reference_tracker import ReferenceTracker, run_tracker, same_tracks
+from tracker import Tracker, greedy_assignment
+from utils import (get_content_deltas, get_content_descriptor, get_content_descriptor_distance,
+                   get_content_descriptors, iou_matrix)
+from video_reader import BatchedVideoReader, FFmpegVideoReader, ParallelVideoReader, VideoReader
+
+
+def time_reader(reader: BatchedVideoReader):
+    """Number of frames read from the whole video and elapsed time."""
+    num_frames = 0
+    reader.start()
+    start_time = time.time()
+    for frame_batch, _ in reader.read_batch():
+        num_frames += len(frame_batch)
+    end_time = time.time()
+    reader.stop()
+    return num_frames, end_time - start_time
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--frame-rates', type=float, nargs='+', help='Frame rates to read the video.')
+@argh.arg('--modes', type=str, nargs='+', help='Sampling modes to compare.')
+@argh.arg('--batch-size', type=int, help='Batch size for the reader.')
+def sampling(video_path: str,
+             frame_rates: List[float] = (30.0, 10.0, 5.0, 1.0),
+             modes: List[str] = VideoReader.sampling_modes,
+             batch_size: int = 32):
+    """Compares the decoding speed of the reader sampling modes across frame rates."""
+    stream = cv2.VideoCapture(video_path)
+    source_fps = stream.get(cv2.CAP_PROP_FPS)
+    stream.release()
+
+    print(f'{video_path} [{source_fps:.2f} fps]')
+    print(f'{"mode":>6} {"rate":>6} {"frames":>8} {"seconds":>8} {"frames/s":>10} {"video s/s":>10}')
+    for frame_rate in frame_rates:
+        for mode in modes:
+            reader = BatchedVideoReader(frame_rate, batch_size, sampling=mode)
+            reader.open(video_path)
+            duration = reader.get_duration()
+            num_frames, elapsed = time_reader(reader)
+            reader.close()
+            print(f'{mode:>6} {frame_rate:>6.2f} {num_frames:>8d} {elapsed:>8.2f} '
+                  f'{num_frames / elapsed:>10.1f} {duration / elapsed:>10.1f}')
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--workers', type=int, nargs='+', help='Numbers of decoding processes to compare.')
+@argh.arg('--segment-length', type=int, help='Frames per segment of the parallel reader.')
+@argh.arg('--batch-size', type=int, help='Batch size for the reader.')
+@argh.arg('--scale', type=float, help='Scale of the frames read.')
+@argh.arg('--ffmpeg-path', type=str, help='ffmpeg executable, to compare the ffmpeg reader.')
+def decoding(video_path: str,
+             frame_rate: float = 30.0,
+             workers: List[int] = (1, 2, 4, 8),
+             segment_length: int = 32,
+             batch_size: int = 32,
+             scale: float = 1.0,
+             ffmpeg_path: str = None):
+    """Compares the threaded reader against the multi-process reader, and the ffmpeg reader."""
+    print(f'{"reader":>10} {"workers":>8} {"frames":>8} {"seconds":>8} {"frames/s":>10}')
+
+    reader = BatchedVideoReader(frame_rate, batch_size)
+    reader.set_scale(scale)
+    reader.open(video_path)
+    num_frames, elapsed = time_reader(reader)
+    reader.close()
+    print(f'{"thread":>10} {1:>8d} {num_frames:>8d} {elapsed:>8.2f} {num_frames / elapsed:>10.1f}')
+
+    for num_workers in workers:
+        reader = ParallelVideoReader(frame_rate, batch_size, num_workers=num_workers, segment_length=segment_length)
+        reader.set_scale(scale)
+        reader.open(video_path)
+        num_frames, elapsed = time_reader(reader)
+        reader.close()
+        print(f'{"process":>10} {num_workers:>8d} {num_frames:>8d} {elapsed:>8.2f} {num_frames / elapsed:>10.1f}')
+
+    if ffmpeg_path:
+        reader = FFmpegVideoReader(frame_rate, batch_size, ffmpeg_path=ffmpeg_path)
+        reader.set_scale(scale)
+        reader.open(video_path)
+        num_frames, elapsed = time_reader(reader)
+        reader.close()
+        print(f'{"ffmpeg":>10} {1:>8d} {num_frames:>8d} {elapsed:>8.2f} {num_frames / elapsed:>10.1f}')
+
+
+def time_call(function, repeat: int):
+    """Result of the function and best elapsed time out of `repeat` calls."""
+    best_time = float('inf')
+    for _ in range(repeat):
+        start_time = time.time()
+        result = function()
+        best_time = min(best_time, time.time() - start_time)
+    return result, best_time
+
+
+@argh.arg('detection_path', help='JSON detections file used for the benchmark.')
+@argh.arg('--repeat', type=int, help='Number of repetitions, the best time is kept.')
+def detections_format(detection_path: str, repeat: int = 3):
+    """Compares the size, load time and iteration time of the JSON and NPZ detection formats."""
+    json_path = Path(detection_path)
+    with json_path.open('r', encoding='utf8') as fp:
+        detections = Detections.from_dict(json.load(fp))
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        npz_path = Path(tmp_folder) / json_path.name.replace('.json', '.npz')
+        detections.save(npz_path)
+
+        print(f'{"format":>6} {"size (MB)":>10} {"load (s)":>10} {"iterate (s)":>12}')
+        for path in [json_path, npz_path]:
+            loaded, load_time = time_call(lambda: load_detections(path), repeat)
+            _, iterate_time = time_call(lambda: sum(len(b) for _, _, b, _ in loaded), repeat)
+            print(f'{path.suffix[1:]:>6} {path.stat().st_size / 2 ** 20:>10.2f} {load_time:>10.3f} {iterate_time:>12.3f}')
+
+
+@argh.arg('detection_paths', nargs='+', help='Detection files used for the benchmark.')
+@argh.arg('--content-threshold', type=float, help='Threshold for the shot-transition detector.')
+@argh.arg('--iou-threshold', type=float, help='Threshold for the IOU overlap between different-frame detections.')
+@argh.arg('--max-gap-length', type=float, help='Maximum allowed gap in seconds between corresponding detections.')
+@argh.arg('--min-shot-length', type=float, help='Minimum duration in seconds for a valid track.')
+def tracker_matching(detection_paths: List[str],
+                     content_threshold: float = 250.0,
+                     iou_threshold: float = 0.5,
+                     max_gap_length: float = 1.0,
+                     min_shot_length: float = 10.0):
+    """Checks the vectorized matching against the original one and compares their speed."""
+    args = (content_threshold, iou_threshold, max_gap_length, min_shot_length)
+    print(f'{"video":>20} {"tracks":>7} {"reference (s)":>14} {"vectorized (s)":>15} {"same":>5}')
+    for detection_path in detection_paths:
+        detections = load_detections(detection_path)
+        reference, reference_time = time_call(lambda: run_tracker(ReferenceTracker(*args), detections), 1)
+        vectorized, vectorized_time = time_call(lambda: run_tracker(Tracker(*args), detections), 1)
+        same = same_tracks(reference['tracks'], vectorized['tracks'])
+        print(f'{Path(detection_path).name[:20]:>20} {len(vectorized["tracks"]):>7d} '
+              f'{reference_time:>14.3f} {vectorized_time:>15.3f} {str(same):>5}')
+
+
+@argh.arg('detection_paths', nargs='+', help='Detection files used for the benchmark.')
+@argh.arg('--content-threshold', type=float, help='Threshold for the shot-transition detector.')
+@argh.arg('--iou-threshold', type=float, help='Threshold for the IOU overlap between different-frame detections.')
+@argh.arg('--max-gap-length', type=float, help='Maximum allowed gap in seconds between corresponding detections.')
+@argh.arg('--min-shot-length', type=float, help='Minimum duration in seconds for a valid track.')
+def assignment(detection_paths: List[str],
+               content_threshold: float = 250.0,
+               iou_threshold: float = 0.5,
+               max_gap_length: float = 1.0,
+               min_shot_length: float = 10.0):
+    """Compares the speed and the number of tracks of the tracker assignment strategies."""
+    args = (content_threshold, iou_threshold, max_gap_length, min_shot_length)
+    print(f'{"video":>20} {"assignment":>10} {"detections":>10} {"tracks":>7} {"seconds":>8}')
+    for detection_path in detection_paths:
+        detections = load_detections(detection_path)
+        for name in Tracker.assignments:
+            data, elapsed = time_call(lambda: run_tracker(Tracker(*args, assignment=name), detections), 1)
+            print(f'{Path(detection_path).name[:20]:>20} {name:>10} {len(detections.bounding_box):>10d} '
+                  f'{len(data["tracks"]):>7d} {elapsed:>8.3f}')
+
+
+def read_frames(video_path: str, frame_rate: float, num_frames: int) -> List[np.ndarray]:
+    reader = BatchedVideoReader(frame_rate)
+    reader.open(video_path)
+    reader.start()
+    frames = []
+    for frame_batch, _ in reader.read_batch():
+        frames.extend(frame.copy() for frame in frame_batch)
+        if len(frames) >= num_frames:
+            break
+    reader.clear_queue()
+    reader.stop()
+    reader.close()
+    return frames[:num_frames]
+
+
+def match_faces(reference: List[np.ndarray], bounding_boxes: List[np.ndarray]):
+    """Number of faces, recall, precision and mean IOU of the faces paired with the reference ones."""
+    num_reference = num_found = num_matched = 0
+    matched_ious = []
+    for reference_boxes, found_boxes in zip(reference, bounding_boxes):
+        num_reference += len(reference_boxes)
+        num_found += len(found_boxes)
+        if len(reference_boxes) > 0 and len(found_boxes) > 0:
+            iou_mat = iou_matrix(reference_boxes, found_boxes)
+            pairs = greedy_assignment(iou_mat, 0.5)
+            num_matched += len(pairs)
+            matched_ious.extend(iou_mat[i, j] for i, j in pairs)
+    return (num_found, num_matched / max(num_reference, 1), num_matched / max(num_found, 1),
+            np.mean(matched_ious) if matched_ious else 0.0)
+
+
+def time_detector(detector: FaceDetector, frames: List[np.ndarray], batch_size: int):
+    """Faces of the frames detected in batches, and the elapsed time."""
+    bounding_boxes = []
+    start_time = time.time()
+    for i in range(0, len(frames), batch_size):
+        bounding_box_batch, _ = detector(frames[i:i + batch_size])
+        bounding_boxes.extend(bounding_box_batch)
+    return bounding_boxes, time.time() - start_time
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--model-path', help='Model file of the yunet backend.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--num-frames', type=int, help='Number of frames detected.')
+@argh.arg('--batch-size', type=int, help='Batch size for the face detector.')
+@argh.arg('--num-threads', type=int, nargs='+', help='Thread counts of the yunet backend to compare.')
+@argh.arg('--min-face-size', type=int, help='Minimum size of a face required by the face detector.')
+@argh.arg('--frame-scale', type=float, help='Scaling factor for all frames.')
+@argh.arg('--use-gpu', action='store_true', help='Whether MTCNN should use the GPU.')
+def detector_backends(video_path: str,
+                      model_path: str = None,
+                      frame_rate: float = 5.0,
+                      num_frames: int = 100,
+                      batch_size: int = 16,
+                      num_threads: List[int] = (1, 4),
+                      min_face_size: int = 20,
+                      frame_scale: float = 1.0,
+                      use_gpu: bool = False):
+    """Compares the speed and the recall and precision against MTCNN of the detector backends."""
+    frames = read_frames(video_path, frame_rate, num_frames)
+    setups = [('mtcnn', 0)] + ([('yunet', n) for n in num_threads] if model_path else [])
+
+    reference = None
+    print(f'{"backend":>8} {"threads":>8} {"frames/s":>9} {"faces":>7} {"recall":>7} {"precision":>10} {"iou":>6}')
+    for backend, threads in setups:
+        detector = FaceDetector(min_face_size, None, use_gpu, frame_scale, backend, model_path, threads)
+        bounding_boxes, elapsed = time_detector(detector, frames, batch_size)
+        reference = bounding_boxes if reference is None else reference
+
+        num_found, recall, precision, mean_iou = match_faces(reference, bounding_boxes)
+        print(f'{backend:>8} {threads:>8d} {len(frames) / elapsed:>9.2f} {num_found:>7d} '
+              f'{recall:>7.3f} {precision:>10.3f} {mean_iou:>6.3f}')
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--intervals', type=int, nargs='+', help='Keyframe intervals to compare, 1 detects every frame.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--batch-size', type=int, help='Batch size for the face detector.')
+@argh.arg('--min-face-size', type=int, help='Minimum size of a face required by the face detector.')
+@argh.arg('--frame-scale', type=float, help='Scaling factor for all frames.')
+@argh.arg('--use-gpu', action='store_true', help='Whether the face detector should use the GPU.')
+def keyframe_interval(video_path: str,
+                      intervals: List[int] = (1, 3, 5, 10),
+                      frame_rate: float = 5.0,
+                      batch_size: int = 16,
+                      min_face_size: int = 20,
+                      frame_scale: float = 1.0,
+                      use_gpu: bool = False):
+    """Compares the speed and the faces kept of the detection across keyframe intervals."""
+    detector = FaceDetector(min_face_size, None, use_gpu, frame_scale)
+    reference = None
+    print(f'{"interval":>8} {"keyframes":>10} {"frames/s":>9} {"faces":>7} {"recall":>7} {"precision":>10} {"iou":>6}')
+    for interval in intervals:
+        reader = BatchedVideoReader(frame_rate, batch_size)
+        reader.open(video_path)
+        data = detect_faces_on_video(reader, detector, keyframe_interval=interval)
+        reader.close()
+        bounding_boxes = [np.asarray(b, dtype=np.float32).reshape(-1, 4) for b in data['bounding_box']]
+        reference = bounding_boxes if reference is None else reference
+
+        num_keyframes = data.get('num_keyframes', len(bounding_boxes))
+        num_found, recall, precision, mean_iou = match_faces(reference, bounding_boxes)
+        print(f'{interval:>8d} {num_keyframes:>10d} {len(bounding_boxes) / data["detection_length"]:>9.2f} '
+              f'{num_found:>7d} {recall:>7.3f} {precision:>10.3f} {mean_iou:>6.3f}')
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--intervals', type=int, nargs='+', help='Intervals between the full frame detections to compare.')
+@argh.arg('--margins', type=float, nargs='+', help='Margins of the regions around the faces to compare.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--batch-size', type=int, help='Batch size for the face detector.')
+@argh.arg('--min-face-size', type=int, help='Minimum size of a face required by the face detector.')
+@argh.arg('--frame-scale', type=float, help='Scaling factor for all frames.')
+@argh.arg('--use-gpu', action='store_true', help='Whether the face detector should use the GPU.')
+def region_detection(video_path: str,
+                     intervals: List[int] = (5, 10, 30),
+                     margins: List[float] = (0.5, 1.0),
+                     frame_rate: float = 5.0,
+                     batch_size: int = 16,
+                     min_face_size: int = 20,
+                     frame_scale: float = 1.0,
+                     use_gpu: bool = False):
+    """Compares the speed and the faces kept of detecting only around the open tracks."""
+    detector = FaceDetector(min_face_size, None, use_gpu, frame_scale)
+    setups = [(1, None)] + [(interval, margin) for interval in intervals for margin in margins]
+    reference = reference_time = None
+    print(f'{"interval":>8} {"margin":>7} {"keyframes":>10} {"speedup":>8} {"faces":>7} {"recall":>7} '
+          f'{"precision":>10} {"iou":>6}')
+    for interval, margin in setups:
+        reader = BatchedVideoReader(frame_rate, batch_size)
+        reader.open(video_path)
+        data = detect_faces_on_video(reader, detector, keyframe_interval=interval, region_margin=margin)
+        reader.close()
+        bounding_boxes = [np.asarray(b, dtype=np.float32).reshape(-1, 4) for b in data['bounding_box']]
+        reference = bounding_boxes if reference is None else reference
+        reference_time = data['detection_length'] if reference_time is None else reference_time
+
+        num_keyframes = data.get('num_keyframes', len(bounding_boxes))
+        num_found, recall, precision, mean_iou = match_faces(reference, bounding_boxes)
+        print(f'{interval:>8d} {margin or 0:>7.2f} {num_keyframes:>10d} '
+              f'{reference_time / data["detection_length"]:>8.2f} {num_found:>7d} {recall:>7.3f} '
+              f'{precision:>10.3f} {mean_iou:>6.3f}')
+
+
+def time_threads(result_queue: multiprocessing.Queue, video_path: str, frame_rate: float, batch_size: int,
+                 frame_scale: float, replicas: int, intra_op_threads: int, inter_op_threads: int):
+    """Sends the frames detected by second with the thread settings, run in a process of its own."""
+    detector = FaceDetector(20, None, False, frame_scale, intra_op_threads=intra_op_threads,
+                            inter_op_threads=inter_op_threads, num_replicas=replicas)
+    reader = BatchedVideoReader(frame_rate, batch_size)
+    reader.open(video_path)
+    # Warm up the detector, or its replicas
+    for _ in range(max(1, replicas)):
+        detector(read_frames(video_path, frame_rate, 1))
+    data = detect_faces_on_video(reader, detector, inference_workers=max(1, replicas))
+    reader.close()
+    detector.close()
+    result_queue.put(len(data['time']) / data['detection_length'])
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--replicas', type=int, nargs='+', help='Numbers of detector processes to compare, 0 detects in the '
+                                                  'benchmark process.')
+@argh.arg('--intra-op-threads', type=int, nargs='+', help='Torch intra-op threads to compare, 0 for the default.')
+@argh.arg('--inter-op-threads', type=int, nargs='+', help='Torch inter-op threads to compare, 0 for the default.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--batch-size', type=int, help='Batch size for the face detector.')
+@argh.arg('--frame-scale', type=float, help='Scaling factor for all frames.')
+def cpu_threads(video_path: str,
+                replicas: List[int] = (0, 2),
+                intra_op_threads: List[int] = (0, 1),
+                inter_op_threads: List[int] = (0,),
+                frame_rate: float = 2.0,
+                batch_size: int = 16,
+                frame_scale: float = 1.0):
+    """Compares the frames detected by second across torch thread settings and replicas."""
+    context = multiprocessing.get_context('spawn')
+    print(f'CPUs: {multiprocessing.cpu_count()}, torch default threads: {torch.get_num_threads()}')
+    print(f'{"replicas":>9} {"intra-op":>9} {"inter-op":>9} {"frames/s":>9}')
+    for num_replicas, intra, inter in itertools.product(replicas, intra_op_threads, inter_op_threads):
+        result_queue = context.Queue()
+        process = context.Process(target=time_threads, args=(result_queue, video_path, frame_rate, batch_size,
+                                                             frame_scale, num_replicas, intra, inter))
+        process.start()
+        frames_per_second = result_queue.get()
+        process.join()
+        print(f'{num_replicas:>9d} {intra or "auto":>9} {inter or "auto":>9} {frames_per_second:>9.2f}')
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--num-frames', type=int, help='Number of frames detected.')
+@argh.arg('--batch-size', type=int, help='Batch size for the face detector.')
+@argh.arg('--min-face-size', type=int, help='Minimum size of a face required by the face detector.')
+@argh.arg('--frame-scale', type=float, help='Scaling factor for all frames.')
+def mtcnn_models(video_path: str,
+                 frame_rate: float = 5.0,
+                 num_frames: int = 100,
+                 batch_size: int = 16,
+                 min_face_size: int = 20,
+                 frame_scale: float = 1.0):
+    """Compares the load time, speed and faces kept of the MTCNN models on the CPU."""
+    frames = read_frames(video_path, frame_rate, num_frames)
+    reference = None
+    print(f'{"model":>10} {"load (s)":>9} {"cached (s)":>11} {"frames/s":>9} {"faces":>7} {"recall":>7} '
+          f'{"precision":>10} {"iou":>6}')
+    with tempfile.TemporaryDirectory() as model_cache:
+        for mtcnn_model in MTCNN_MODELS:
+            load_times = []
+            for _ in range(2):
+                start_time = time.time()
+                detector = FaceDetector(min_face_size, None, False, frame_scale, mtcnn_model=mtcnn_model,
+                                        model_cache=model_cache)
+                load_times.append(time.time() - start_time)
+            bounding_boxes, elapsed = time_detector(detector, frames, batch_size)
+            reference = bounding_boxes if reference is None else reference
+
+            num_found, recall, precision, mean_iou = match_faces(reference, bounding_boxes)
+            print(f'{detector.mtcnn_model:>10} {load_times[0]:>9.2f} {load_times[1]:>11.2f} '
+                  f'{len(frames) / elapsed:>9.2f} {num_found:>7d} {recall:>7.3f} {precision:>10.3f} {mean_iou:>6.3f}')
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--num-frames', type=int, help='Number of frames compared.')
+@argh.arg('--batch-size', type=int, help='Frames per call of the batched functions.')
+@argh.arg('--repeat', type=int, help='Number of repetitions, the best time is kept.')
+def content_deltas(video_path: str,
+                   frame_rate: float = 5.0,
+                   num_frames: int = 256,
+                   batch_size: int = 32,
+                   repeat: int = 3):
+    """Checks the content deltas against exact distances and compares their speed by batches."""
+    frames = read_frames(video_path, frame_rate, num_frames)
+    batches = [frames[i:i + batch_size] for i in range(0, len(frames), batch_size)]
+
+    frame_descriptors, frame_descriptor_time = time_call(lambda: [get_content_descriptor(f) for f in frames], repeat)
+
+    def frame_deltas():
+        prev_descriptor = 0
+        deltas = []
+        for descriptor in frame_descriptors:
+            deltas.append(get_content_descriptor_distance(descriptor, prev_descriptor))
+            prev_descriptor = descriptor
+        return np.array(deltas)
+
+    def batch_deltas():
+        prev_descriptor = None
+        deltas = []
+        for descriptors in batch_descriptors:
+            deltas.append(get_content_deltas(descriptors, prev_descriptor))
+            prev_descriptor = descriptors[-1]
+        return np.concatenate(deltas)
+
+    frame_delta_values, frame_delta_time = time_call(frame_deltas, repeat)
+    batch_descriptors, batch_descriptor_time = time_call(lambda: [get_content_descriptors(b) for b in batches], repeat)
+    batch_delta_values, batch_delta_time = time_call(batch_deltas, repeat)
+
+    descriptors = np.concatenate(batch_descriptors).astype(np.int64)
+    differences = np.diff(np.concatenate([np.zeros_like(descriptors[:1]), descriptors]), axis=0)
+    exact_deltas = np.sqrt(np.sum(differences ** 2, axis=1))
+    # The original distance subtracted and squared uint8 descriptors
+    uint8_deltas = np.sqrt(np.sum(differences.astype(np.uint8) ** 2, axis=1))
+
+    print(f'{"method":>10} {"descriptor (ms)":>16} {"delta (us)":>11} {"max error":>10} {"correct":>8}')
+    for name, values, descriptor_time, delta_time in [
+            ('uint8', uint8_deltas, np.nan, np.nan),
+            ('frame', frame_delta_values, frame_descriptor_time, frame_delta_time),
+            ('batch', batch_delta_values, batch_descriptor_time, batch_delta_time)]:
+        error = np.max(np.abs(values - exact_deltas) / np.maximum(exact_deltas, 1))
+        print(f'{name:>10} {1e3 * descriptor_time / len(frames):>16.3f} {1e6 * delta_time / len(frames):>11.2f} '
+              f'{error:>10.2e} {str(error < 1e-5):>8}')
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--batch-sizes', type=int, nargs='+', help='Batch sizes to compare.')
+@argh.arg('--frame-scale', type=float, help='Scale of the frames for the face detector.')
+@argh.arg('--repeat', type=int, help='Number of repetitions, the best time is kept.')
+@argh.arg('--use-gpu', help='Preprocess on the GPU.')
+def preprocessing(video_path: str,
+                  frame_rate: float = 5.0,
+                  batch_sizes: List[int] = (1, 4, 16, 64),
+                  frame_scale: float = 0.5,
+                  repeat: int = 5,
+                  use_gpu: bool = False):
+    """Compares the OpenCV preprocessing against the batched tensor preprocessing."""
+    frames = read_frames(video_path, frame_rate, max(batch_sizes))
+    detector = FaceDetector(20, None, use_gpu, frame_scale)
+    device = detector.backend.device
+
+    def to_model(frames):
+        # The first step of MTCNN
+        frames = torch.as_tensor(frames, device=device).permute(0, 3, 1, 2).float()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return frames
+
+    print(f'{"batch":>6} {"opencv ms/frame":>16} {"tensor ms/frame":>16} {"speedup":>8} {"max diff":>9}')
+    for batch_size in batch_sizes:
+        frame_batch = frames[:batch_size]
+        expected, opencv_time = time_call(lambda: to_model(detector.preprocess(frame_batch)), repeat)
+        result, tensor_time = time_call(lambda: to_model(detector.preprocess_tensor(frame_batch)), repeat)
+        max_diff = (expected - result).abs().max().item()
+        print(f'{len(frame_batch):>6d} {1e3 * opencv_time / len(frame_batch):>16.3f} '
+              f'{1e3 * tensor_time / len(frame_batch):>16.3f} {opencv_time / tensor_time:>8.2f} {max_diff:>9.0f}')
+
+
+@argh.arg('video_path', help='Video used for the benchmark.')
+@argh.arg('detection_paths', nargs='+', help='Earlier detections files the face sizes are learned from.')
+@argh.arg('--frame-rate', type=float, help='Frame rate to read the video.')
+@argh.arg('--num-frames', type=int, help='Number of frames detected.')
+@argh.arg('--batch-size', type=int, help='Batch size for the face detector.')
+@argh.arg('--min-face-size', type=int, help='Minimum size of a face required by the face detector.')
+@argh.arg('--quantiles', type=float, nargs='+', help='Quantiles of the learned face sizes to compare.')
+@argh.arg('--frame-scale', type=float, help='Scale of the frames for the face detector.')
+@argh.arg('--use-gpu', help='Run the face detector on the GPU.')
+def face_sizes(video_path: str,
+               detection_paths: List[str],
+               frame_rate: float = 5.0,
+               num_frames: int = 100,
+               batch_size: int = 16,
+               min_face_size: int = 20,
+               quantiles: List[float] = (0.0, 0.005, 0.05),
+               frame_scale: float = 1.0,
+               use_gpu: bool = False):
+    """Compares the speed and faces kept of MTCNN searching all face sizes or the learned ones."""
+    frames = read_frames(video_path, frame_rate, num_frames)
+    print(f'{"quantile":>9} {"min size":>9} {"max size":>9} {"frames/s":>9} {"faces":>7} {"recall":>7} {"iou":>6}')
+    detector = FaceDetector(min_face_size, None, use_gpu, frame_scale)
+    reference, elapsed = time_detector(detector, frames, batch_size)
+    height, width = detector.get_preprocessed_shape(1, *frames[0].shape[:2])[1:3]
+    print(f'{"-":>9} {min_face_size:>9.1f} {"-":>9} {len(frames) / elapsed:>9.2f} {sum(map(len, reference)):>7d}')
+    for quantile in quantiles:
+        face_size_range = get_face_size_range(detection_paths, quantile)
+        detector = FaceDetector(min_face_size, None, use_gpu, frame_scale, face_size_range=face_size_range)
+        bounding_boxes, elapsed = time_detector(detector, frames, batch_size)
+        num_found, recall, _, mean_iou = match_faces(reference, bounding_boxes)
+        min_size, max_size = detector.get_face_sizes(height, width)
+        print(f'{quantile:>9.3f} {min_size:>9.1f} {max_size:>9.1f} {len(frames) / elapsed:>9.2f} {num_found:>7d} '
+              f'{recall:>7.3f} {mean_iou:>6.3f}')
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands([sampling, decoding, detections_format, tracker_matching, assignment,
+                            detector_backends, keyframe_interval, region_detection, content_deltas, preprocessing,
+                            face_sizes, cpu_threads, mtcnn_models])
@@ -0,0 +1,282 @@
+import copy
+import json
+import functools
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Tuple, Union
+
+import numpy as np
+
+# Per-frame columns of a detections file, the other fields are metadata
+FRAME_COLUMNS = ('time', 'content_delta', 'bounding_box', 'key_points')
+FORMATS = ('json', 'npz')
+# Characters that may follow a complete JSON value, and a key
+_DELIMITERS = ' \t\r\n,]}'
+_KEY_DELIMITERS = ' \t\r\n:'
+
+
+class Detections:
+    """Detections of a video as flat arrays, the faces of frame i in rows offsets[i]:offsets[i + 1]."""
+
+    def __init__(self,
+                 metadata: dict,
+                 time: np.ndarray,
+                 content_delta: np.ndarray,
+                 offsets: np.ndarray,
+                 bounding_box: np.ndarray,
+                 key_points: np.ndarray):
+        self.metadata = metadata
+        self.time = time
+        self.content_delta = content_delta
+        self.offsets = offsets
+        self.bounding_box = bounding_box
+        self.key_points = key_points
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, index: int):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.time[index], self.content_delta[index], self.bounding_box[start:end], self.key_points[start:end]
+
+    def __iter__(self):
+        """Yields (timestamp, content_delta, bounding_box, key_points) for each frame."""
+        for index in range(len(self)):
+            yield self[index]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Detections':
+        metadata = {key: value for key, value in data.items() if key not in FRAME_COLUMNS}
+        counts = [len(b) for b in data['bounding_box']]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        bounding_box = [np.asarray(b, dtype=np.float32).reshape(-1, 4) for b in data['bounding_box']]
+        key_points = [np.asarray(p, dtype=np.float32).reshape(-1, 5, 2) for p in data['key_points']]
+        return cls(metadata,
+                   np.asarray(data['time'], dtype=np.float64),
+                   np.asarray(data['content_delta'], dtype=np.float32),
+                   offsets,
+                   np.concatenate(bounding_box) if bounding_box else np.zeros((0, 4), dtype=np.float32),
+                   np.concatenate(key_points) if key_points else np.zeros((0, 5, 2), dtype=np.float32))
+
+    def to_dict(self) -> dict:
+        data = dict(self.metadata)
+        data['time'] = self.time.tolist()
+        data['content_delta'] = self.content_delta.tolist()
+        data['bounding_box'] = [self.bounding_box[s:e].tolist() for s, e in zip(self.offsets[:-1], self.offsets[1:])]
+        data['key_points'] = [self.key_points[s:e].tolist() for s, e in zip(self.offsets[:-1], self.offsets[1:])]
+        return data
+
+    def save(self, path: Union[str, Path]):
+        with Path(path).open('wb') as fp:
+            np.savez(fp,
+                     metadata=np.array(json.dumps(self.metadata, default=lambda obj: obj.tolist())),
+                     time=self.time,
+                     content_delta=self.content_delta,
+                     offsets=self.offsets,
+                     bounding_box=self.bounding_box,
+                     key_points=self.key_points)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'Detections':
+        with np.load(str(path)) as data:
+            return cls(json.loads(str(data['metadata'])),
+                       data['time'],
+                       data['content_delta'],
+                       data['offsets'],
+                       data['bounding_box'],
+                       data['key_points'])
+
+
+def detections_path(folder: Path, stem: str, detections_format: str) -> Path:
+    return folder / f'{stem}.detections.{detections_format}'
+
+
+def load_detections(path: Union[str, Path]) -> Detections:
+    path = Path(path)
+    if path.suffix == '.npz':
+        return Detections.load(path)
+    with path.open('r', encoding='utf8') as fp:
+        return Detections.from_dict(json.load(fp))
+
+
+def save_detections(data: Union[dict, Detections], path: Union[str, Path], encoder: type = None):
+    """Saves the detections in the format given by the suffix of `path`."""
+    path = Path(path)
+    if path.suffix == '.npz':
+        if isinstance(data, dict):
+            data = Detections.from_dict(data)
+        data.save(path)
+    else:
+        if isinstance(data, Detections):
+            data = data.to_dict()
+        with path.open('w', encoding='utf8') as wp:
+            json.dump(data, wp, cls=encoder)
+
+
+def _next_token(fp: BinaryIO, offset: int, skipped: bytes = b' \t\r\n,:{') -> Tuple[int, bytes]:
+    """Offset and first byte of the next token, skipping whitespace and separators."""
+    fp.seek(offset)
+    while True:
+        char = fp.read(1)
+        if not char:
+            raise ValueError('Unexpected end of the detections file')
+        if char not in skipped:
+            return offset, char
+        offset += 1
+
+
+def _decode_at(fp: BinaryIO, offset: int, chunk_size: int, delimiters: str = _DELIMITERS) -> Tuple[object, int]:
+    """JSON value at `offset` and its end offset."""
+    decoder = json.JSONDecoder()
+    size = chunk_size
+    while True:
+        fp.seek(offset)
+        # The files are ASCII, decoding as latin-1 keeps the offsets of the bytes
+        text = fp.read(size).decode('latin-1')
+        end_of_file = len(text) < size
+        try:
+            value, end = decoder.raw_decode(text)
+        except json.JSONDecodeError as err:
+            if end_of_file:
+                raise err
+        else:
+            # A value not followed by a delimiter may be cut, e.g. a number
+            if (end < len(text) and text[end] in delimiters) or end_of_file:
+                return value, offset + end
+        size *= 2
+
+
+def _skip_array(fp: BinaryIO, offset: int, chunk_size: int) -> int:
+    """End offset of the array at `offset`, found by counting brackets."""
+    fp.seek(offset)
+    depth = 0
+    while True:
+        chunk = np.frombuffer(fp.read(chunk_size), dtype=np.uint8)
+        if len(chunk) == 0:
+            raise ValueError('Unterminated array in the detections file')
+        depths = depth + np.cumsum((chunk == ord('[')).astype(np.int64) - (chunk == ord(']')))
+        closed = np.flatnonzero(depths == 0)
+        if len(closed) > 0:
+            return offset + int(closed[0]) + 1
+        depth = depths[-1]
+        offset += len(chunk)
+
+
+def _iter_fields(fp: BinaryIO, chunk_size: int) -> Iterator[Tuple[str, int, object]]:
+    """Yields the key, offset and value of each field, None for the skipped frame columns."""
+    offset = 0
+    while True:
+        offset, char = _next_token(fp, offset)
+        if char == b'}':
+            return
+        key, offset = _decode_at(fp, offset, chunk_size, _KEY_DELIMITERS)
+        # The value may be an object, keep its brace
+        offset, _ = _next_token(fp, offset, b' \t\r\n:')
+        value_offset = offset
+        if key in FRAME_COLUMNS:
+            value, offset = None, _skip_array(fp, offset, chunk_size)
+        else:
+            value, offset = _decode_at(fp, offset, chunk_size)
+        yield key, value_offset, value
+
+
+def _scan_fields(fp: BinaryIO, chunk_size: int) -> Tuple[dict, dict]:
+    """Metadata and offsets of the frame columns, without parsing the columns."""
+    metadata, offsets = {}, {}
+    for key, offset, value in _iter_fields(fp, chunk_size):
+        if key in FRAME_COLUMNS:
+            offsets[key] = offset
+        else:
+            metadata[key] = value
+    return metadata, offsets
+
+
+@functools.lru_cache(maxsize=16)
+def _scan_file(path: str, mtime_ns: int, size: int, chunk_size: int) -> Tuple[dict, dict]:
+    """Cached by modification time and size."""
+    with open(path, 'rb') as fp:
+        return _scan_fields(fp, chunk_size)
+
+
+def _load_header(path: Path, chunk_size: int) -> Tuple[dict, dict]:
+    stat = path.stat()
+    metadata, offsets = _scan_file(str(path.resolve()), stat.st_mtime_ns, stat.st_size, chunk_size)
+    # The cached metadata is not shared with the callers
+    return copy.deepcopy(metadata), offsets
+
+
+def load_metadata(path: Union[str, Path], chunk_size: int = 2 ** 16) -> dict:
+    """Fields of a detections file other than the frame columns."""
+    path = Path(path)
+    if path.suffix == '.npz':
+        with np.load(str(path)) as data:
+            return json.loads(str(data['metadata']))
+    return _load_header(path, chunk_size)[0]
+
+
+def _iter_array(path: Path, offset: int, chunk_size: int) -> Iterator:
+    """Yields the items of the JSON array at `offset`, a chunk at a time."""
+    decoder = json.JSONDecoder()
+    with path.open('rb') as fp:
+        fp.seek(offset + 1)
+        text, position, end_of_file = '', 0, False
+        while True:
+            while position < len(text) and text[position] in ' \t\r\n,':
+                position += 1
+            if position < len(text) and text[position] == ']':
+                return
+
+            end = None
+            if position < len(text):
+                try:
+                    value, end = decoder.raw_decode(text, position)
+                except json.JSONDecodeError:
+                    end = None
+            # An item not followed by a delimiter may be cut, e.g. a number
+            if end is None or (not end_of_file and (end == len(text) or text[end] not in _DELIMITERS)):
+                if end_of_file:
+                    raise ValueError(f'Unterminated array in "{path}"')
+                chunk = fp.read(chunk_size)
+                end_of_file = len(chunk) == 0
+                text = text[position:] + chunk.decode('latin-1')
+                position = 0
+                continue
+
+            yield value
+            position = end
+
+
+def iter_detections(path: Union[str, Path], chunk_size: int = 2 ** 16) -> Iterator:
+    """Iterates the frames of a detections file like `load_detections`, parsing JSON a chunk at a time."""
+    path = Path(path)
+    if path.suffix == '.npz':
+        yield from Detections.load(path)
+        return
+
+    _, offsets = _load_header(path, chunk_size)
+    if len(offsets) < len(FRAME_COLUMNS):
+        raise KeyError(f'Missing columns {set(FRAME_COLUMNS) - set(offsets)}')
+    columns = [_iter_array(path, offsets[name], chunk_size) for name in FRAME_COLUMNS]
+    for timestamp, content_delta, bounding_box, key_points in zip(*columns):
+        # Same types as the columns of `Detections`
+        yield (timestamp,
+               np.float32(content_delta),
+               np.asarray(bounding_box, dtype=np.float32).reshape(-1, 4),
+               np.asarray(key_points, dtype=np.float32).reshape(-1, 5, 2))
+
+
+def get_face_size_range(paths: List[Union[str, Path]], quantile: float = 0.005) -> Tuple[float, float]:
+    """Face sizes of earlier detections, as fractions of the shorter side of their frames."""
+    short_sides, long_sides = [], []
+    for path in paths:
+        metadata = load_metadata(path)
+        frame_size = min(metadata['width'], metadata['height'])
+        for _, _, bounding_box, _ in iter_detections(path):
+            sides = bounding_box[:, 2:] - bounding_box[:, :2]
+            short_sides.append(sides.min(axis=1) / frame_size)
+            long_sides.append(sides.max(axis=1) / frame_size)
+    if sum(len(sides) for sides in short_sides) == 0:
+        raise ValueError('No faces in the detections')
+    return (float(np.quantile(np.concatenate(short_sides), quantile)),
+            float(np.quantile(np.concatenate(long_sides), 1 - quantile)))
@@ -1,36 +1,489 @@
-from typing import List, Tuple
+import os
+import hashlib
+import traceback
+import warnings
+import multiprocessing
+from pathlib import Path
+from queue import Empty
+from threading import Condition, Lock, Thread
+from typing import List, Tuple, Union
 
 import cv2
 import torch
 import numpy as np
 from facenet_pytorch import MTCNN
+from torch.nn.functional import interpolate
+
+from utils import get_regions, iou_matrix
+
+# Scale between the levels of the MTCNN image pyramid
+PYRAMID_FACTOR = 0.709
+# Versions of the MTCNN nets: the facenet_pytorch modules, their TorchScript traces, and the
+# traces with the linear layers quantized to int8
+MTCNN_MODELS = ('float', 'script', 'quantized')
+MODEL_CACHE = Path.home() / '.cache' / 'chiletv' / 'mtcnn'
+
+
+class CappedPNet(torch.nn.Module):
+    """P-Net skipping the pyramid levels below `min_scale`, which only find faces above the largest searched."""
+
+    def __init__(self, pnet: torch.nn.Module):
+        super().__init__()
+        self.pnet = pnet
+        self.min_scale = 0.0
+        self.frame_height = 0
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if x.shape[2] < self.min_scale * self.frame_height:
+            return x.new_zeros((len(x), 4, 0, 0)), x.new_zeros((len(x), 2, 0, 0))
+        return self.pnet(x)
+
+
+def set_torch_threads(intra_op_threads: int = 0, inter_op_threads: int = 0):
+    """Sets the intra-op and inter-op threads of torch, 0 keeps the default."""
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0 and torch.get_num_interop_threads() != inter_op_threads:
+        torch.set_num_interop_threads(inter_op_threads)
+
+
+def get_state_hash(module: torch.nn.Module) -> str:
+    digest = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        digest.update(name.encode('utf8'))
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def compile_net(net: torch.nn.Module, example: torch.Tensor, quantized: bool, cache_folder: Path) -> torch.nn.Module:
+    """TorchScript trace of a net, int8 quantized when `quantized`, cached in `cache_folder`."""
+    model = 'quantized' if quantized else 'script'
+    path = cache_folder / f'{type(net).__name__.lower()}-{model}-{get_state_hash(net)}-torch{torch.__version__}.pt'
+    if path.exists():
+        return torch.jit.load(str(path), map_location='cpu')
+
+    net = net.cpu().eval()
+    if quantized:
+        net = torch.quantization.quantize_dynamic(net, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example)
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    # Replicas may compile the same net at once
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    traced.save(str(tmp_path))
+    tmp_path.replace(path)
+    return traced
+
+
+class MTCNNBackend:
+    """facenet_pytorch MTCNN, on the GPU when available. Takes RGB frames."""
+
+    input_rgb = True
+    # MTCNN takes batches as NHWC tensors, they are not copied when already on its device
+    input_tensor = True
+    # The batch size is bound by the GPU memory, it is probed for each frame size
+    fixed_batch_size = None
+
+    def __init__(self,
+                 min_face_size: int,
+                 use_gpu: bool,
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 mtcnn_model: str = 'float',
+                 model_cache: Union[str, Path] = None):
+        assert mtcnn_model in MTCNN_MODELS, f'Unknown MTCNN model "{mtcnn_model}"'
+        set_torch_threads(intra_op_threads, inter_op_threads)
+        self.device = torch.device('cuda:0' if use_gpu and torch.cuda.is_available() else 'cpu')
+        self.model = MTCNN(min_face_size=min_face_size, factor=PYRAMID_FACTOR, keep_all=True, device=self.device)
+
+        self.mtcnn_model = 'float'
+        if mtcnn_model != 'float' and self.device.type != 'cpu':
+            warnings.warn(f'The {mtcnn_model} MTCNN only runs on the CPU, using the float one')
+        elif mtcnn_model != 'float':
+            cache_folder = Path(model_cache) if model_cache else MODEL_CACHE
+            quantized = mtcnn_model == 'quantized'
+            try:
+                nets = [compile_net(net, torch.zeros((2, 3, size, size)), quantized, cache_folder)
+                        for net, size in ((self.model.pnet, 12), (self.model.rnet, 24), (self.model.onet, 48))]
+            except (RuntimeError, OSError) as err:
+                warnings.warn(f'Using the float MTCNN, the {mtcnn_model} one failed: {err}')
+            else:
+                self.model.pnet, self.model.rnet, self.model.onet = nets
+                self.mtcnn_model = mtcnn_model
+        self.model.pnet = CappedPNet(self.model.pnet)
+        # The face sizes are set on the shared model for each call, region and keyframe
+        # detections run on different threads
+        self.lock = Lock()
+
+    def get_device_name(self) -> str:
+        if self.device.type == 'cuda':
+            return torch.cuda.get_device_name(self.device)
+        return self.device.type
+
+    def detect(self,
+               frames: Union[np.ndarray, torch.Tensor],
+               min_face_size: float,
+               max_face_size: float = 0) -> Tuple[List[np.array], List[np.array]]:
+        if isinstance(frames, np.ndarray):
+            # MTCNN copies numpy batches before making them tensors
+            frames = torch.from_numpy(frames)
+        with self.lock:
+            self.model.min_face_size = min_face_size
+            self.model.pnet.min_scale = 12.0 * self.model.factor / max_face_size if max_face_size else 0.0
+            self.model.pnet.frame_height = frames.shape[1]
+            bounding_box_batch, _, key_points_batch = self.model.detect(frames, landmarks=True)
+        return bounding_box_batch, key_points_batch
+
+
+class YuNetBackend:
+    """YuNet on the CPU from a local ONNX model of the OpenCV model zoo. Takes BGR frames."""
+
+    input_rgb = False
+    input_tensor = False
+    # Frames are detected one at a time, the batch size only sets how many go through the pipeline at once
+    fixed_batch_size = 16
+
+    def __init__(self,
+                 model_path: Union[str, Path],
+                 num_threads: int = 0,
+                 score_threshold: float = 0.7,
+                 nms_threshold: float = 0.3):
+        if not model_path or not Path(model_path).is_file():
+            raise FileNotFoundError(f'YuNet model "{model_path}" not found')
+        if num_threads > 0:
+            cv2.setNumThreads(num_threads)
+        self.input_size = (320, 320)
+        self.model = cv2.FaceDetectorYN.create(str(model_path), '', self.input_size, score_threshold, nms_threshold)
+
+    def get_device_name(self) -> str:
+        return 'cpu (yunet)'
+
+    def detect(self,
+               frames: np.ndarray,
+               min_face_size: float,
+               max_face_size: float = 0) -> Tuple[List[np.array], List[np.array]]:
+        bounding_box_batch = []
+        key_points_batch = []
+        for frame in frames:
+            height, width = frame.shape[:2]
+            if self.input_size != (width, height):
+                self.input_size = (width, height)
+                self.model.setInputSize(self.input_size)
+
+            # Rows of x, y, width, height, 5 key points and score
+            _, faces = self.model.detect(frame)
+            if faces is not None:
+                sizes = np.minimum(faces[:, 2], faces[:, 3])
+                faces = faces[(sizes >= min_face_size) & ((sizes <= max_face_size) | (max_face_size <= 0))]
+            if faces is None or len(faces) == 0:
+                bounding_box_batch.append(None)
+                key_points_batch.append(None)
+                continue
+
+            bounding_box = faces[:, :4].copy()
+            bounding_box[:, 2:] += bounding_box[:, :2]
+            bounding_box_batch.append(bounding_box)
+            key_points_batch.append(faces[:, 4:14].reshape(-1, 5, 2))
+        return bounding_box_batch, key_points_batch
+
+
+def create_backend(backend: str,
+                   min_face_size: int,
+                   use_gpu: bool,
+                   model_path: str = None,
+                   num_threads: int = 0,
+                   intra_op_threads: int = 0,
+                   inter_op_threads: int = 0,
+                   mtcnn_model: str = 'float',
+                   model_cache: Union[str, Path] = None):
+    if backend == 'yunet':
+        return YuNetBackend(model_path, num_threads)
+    return MTCNNBackend(min_face_size, use_gpu, intra_op_threads, inter_op_threads, mtcnn_model, model_cache)
+
+
+def run_replica(backend_args: tuple, cpus: List[int], task_queue: multiprocessing.Queue,
+                result_queue: multiprocessing.Queue):
+    """Worker of `ReplicaBackend`, detects the batches of the queue until it gets None."""
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    backend = create_backend(*backend_args)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        task_id, frames, min_face_size, max_face_size = task
+        try:
+            result = backend.detect(frames, min_face_size, max_face_size)
+        except Exception:
+            # The error may not be picklable, its traceback always is
+            result = RuntimeError(f'Detector replica failed:\n{traceback.format_exc()}')
+        result_queue.put((task_id, result))
+
+
+class ReplicaBackend:
+    """Runs `num_replicas` copies of a backend in worker processes pinned to shares of the CPUs."""
+
+    input_tensor = False
+    # Frames are detected on the CPU, the batch size only sets how many go to a replica at once
+    fixed_batch_size = 16
+
+    def __init__(self,
+                 num_replicas: int,
+                 backend: str,
+                 min_face_size: int,
+                 use_gpu: bool,
+                 model_path: str = None,
+                 num_threads: int = 0,
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 mtcnn_model: str = 'float',
+                 model_cache: Union[str, Path] = None):
+        self.input_rgb = backend != 'yunet'
+        self.device_name = 'cuda' if use_gpu and torch.cuda.is_available() else 'cpu'
+        context = multiprocessing.get_context('spawn')
+        self.task_queue = context.Queue()
+        # Batches left in the queue, e.g. after a replica failed, must not block the exit
+        self.task_queue.cancel_join_thread()
+        self.result_queue = context.Queue()
+        self.results = {}
+        self.condition = Condition()
+        self.next_task_id = 0
+        self.error = None
+        self.closed = False
+
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(multiprocessing.cpu_count()))
+        self.workers = []
+        for replica_cpus in np.array_split(cpus, num_replicas):
+            replica_cpus = [int(cpu) for cpu in replica_cpus]
+            num_cpus = max(1, len(replica_cpus))
+            backend_args = (backend, min_face_size, use_gpu, model_path, num_threads or num_cpus,
+                            intra_op_threads or num_cpus, inter_op_threads, mtcnn_model, model_cache)
+            worker = context.Process(target=run_replica,
+                                     args=(backend_args, replica_cpus, self.task_queue, self.result_queue))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.collector = Thread(target=self.collect_results)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def get_device_name(self) -> str:
+        return f'{self.device_name} ({len(self.workers)} replicas)'
+
+    def collect_results(self):
+        while not self.closed:
+            try:
+                task_id, result = self.result_queue.get(timeout=1.0)
+            except Empty:
+                if not self.closed and not all(worker.is_alive() for worker in self.workers):
+                    with self.condition:
+                        self.error = RuntimeError('A detector replica exited unexpectedly')
+                        self.condition.notify_all()
+                    return
+                continue
+            with self.condition:
+                self.results[task_id] = result
+                self.condition.notify_all()
+
+    def detect(self,
+               frames: np.ndarray,
+               min_face_size: float,
+               max_face_size: float = 0) -> Tuple[List[np.array], List[np.array]]:
+        with self.condition:
+            task_id = self.next_task_id
+            self.next_task_id += 1
+        self.task_queue.put((task_id, np.ascontiguousarray(frames), min_face_size, max_face_size))
+        with self.condition:
+            while task_id not in self.results:
+                if self.error is not None:
+                    raise self.error
+                self.condition.wait()
+            result = self.results.pop(task_id)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        self.closed = True
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers.clear()
 
 
 class FaceDetector:
-    def __init__(self, min_face_size: int, max_frame_size: int, use_gpu: bool, scale: float = 1.0):
+    backends = ('mtcnn', 'yunet')
+
+    def __init__(self,
+                 min_face_size: int,
+                 max_frame_size: int,
+                 use_gpu: bool,
+                 scale: float = 1.0,
+                 backend: str = 'mtcnn',
+                 model_path: str = None,
+                 num_threads: int = 0,
+                 max_face_size: int = 0,
+                 face_size_range: Tuple[float, float] = None,
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 num_replicas: int = 0,
+                 mtcnn_model: str = 'float',
+                 model_cache: str = None):
+        assert backend in self.backends, f'Unknown backend "{backend}"'
         self.min_face_size = min_face_size
+        self.max_face_size = max_face_size
+        self.face_size_range = face_size_range
         self.max_frame_size = max_frame_size
         self.use_gpu = use_gpu
         self.scale = scale
+        self.frame_buffer = None
 
-        device = torch.device('cuda:0' if use_gpu and torch.cuda.is_available() else 'cpu')
-        self.model = MTCNN(min_face_size=min_face_size, keep_all=True, device=device)
+        self.backend_name = backend
+        if num_replicas > 0:
+            self.backend = ReplicaBackend(num_replicas, backend, min_face_size, use_gpu, model_path, num_threads,
+                                          intra_op_threads, inter_op_threads, mtcnn_model, model_cache)
+        else:
+            self.backend = create_backend(backend, min_face_size, use_gpu, model_path, num_threads, intra_op_threads,
+                                          inter_op_threads, mtcnn_model, model_cache)
+        # The compiled MTCNN falls back to the float one when it fails in this process
+        self.mtcnn_model = getattr(self.backend, 'mtcnn_model', mtcnn_model)
+        # On the CPU, OpenCV preprocesses a frame at a time faster than the tensor operations
+        self.tensor_preprocessing = self.backend.input_tensor and self.backend.device.type == 'cuda'
 
-    def __call__(self, frame_batch: List[np.array]) -> Tuple[List[np.array], List[np.array]]:
-        frames = [
-            cv2.resize(
-                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB),
-                None,
-                fx=self.scale,
-                fy=self.scale)
-            for frame in frame_batch if frame is not None]
+    def get_device_name(self) -> str:
+        return self.backend.get_device_name()
 
-        bounding_box_batch, _, key_points_batch = self.model.detect(frames, landmarks=True)
+    def get_face_sizes(self, height: int, width: int) -> Tuple[float, float]:
+        """Smallest and largest face sizes searched on preprocessed frames, 0 when the largest is open."""
+        min_face_size, max_face_size = self.min_face_size, self.max_face_size
+        if self.face_size_range is not None:
+            min_fraction, max_fraction = self.face_size_range
+            frame_size = min(height, width)
+            if min_fraction * frame_size > min_face_size:
+                # Levels of the pyramid of `min_face_size` skipped, the others are kept as they are
+                num_levels = int(np.log(min_fraction * frame_size / min_face_size) / -np.log(PYRAMID_FACTOR))
+                min_face_size = min_face_size / PYRAMID_FACTOR ** num_levels
+            max_face_size = min(max_face_size or np.inf, max_fraction * frame_size)
+        return min_face_size, max_face_size
 
-        bounding_box_batch = [b / self.scale if b is not None else [] for b in bounding_box_batch]
-        key_points_batch = [p / self.scale if p is not None else [] for p in key_points_batch]
+    def get_preprocessed_shape(self,
+                               batch_size: int,
+                               height: int,
+                               width: int,
+                               scale: float = None) -> Tuple[int, int, int, int]:
+        scale = self.scale if scale is None else scale
+        return batch_size, int(round(height * scale)), int(round(width * scale)), 3
 
-        return bounding_box_batch, key_points_batch
+    def get_frame_buffer(self, batch_size: int, height: int, width: int) -> np.ndarray:
+        shape = self.get_preprocessed_shape(batch_size, height, width)
+        if self.frame_buffer is None \
+                or self.frame_buffer.shape[1:] != shape[1:] \
+                or len(self.frame_buffer) < batch_size:
+            self.frame_buffer = None
+            self.frame_buffer = np.empty(shape, dtype=np.uint8)
+        return self.frame_buffer[:batch_size]
+
+    def preprocess(self, frame_batch: List[np.array], out: np.ndarray = None, scale: float = None) -> np.ndarray:
+        """Scales the frames and converts them for the backend, into `out` or the reused buffer."""
+        scale = self.scale if scale is None else scale
+        frame_batch = [frame for frame in frame_batch if frame is not None]
+        height, width = frame_batch[0].shape[:2]
+        if out is None:
+            frames = self.get_frame_buffer(len(frame_batch), height, width)
+        else:
+            frames = out[:len(frame_batch)]
+        for frame, buffer in zip(frame_batch, frames):
+            if scale == 1.0:
+                np.copyto(buffer, frame)
+            else:
+                cv2.resize(frame, None, dst=buffer, fx=scale, fy=scale)
+            if self.backend.input_rgb:
+                cv2.cvtColor(buffer, cv2.COLOR_BGR2RGB, dst=buffer)
+        return frames
+
+    def preprocess_tensor(self,
+                          frame_batch: List[np.array],
+                          out: np.ndarray = None,
+                          scale: float = None) -> torch.Tensor:
+        """Like `preprocess`, as tensor operations on the whole batch on the device of the backend."""
+        scale = self.scale if scale is None else scale
+        frame_batch = [frame for frame in frame_batch if frame is not None]
+        if out is not None:
+            out = out[:len(frame_batch)]
+        frames = torch.from_numpy(np.stack(frame_batch, out=out)).to(self.backend.device)
+        # NCHW view of the NHWC batch, the channels last layout is kept by the operations
+        frames = frames.permute(0, 3, 1, 2)
+        if scale != 1.0:
+            _, height, width, _ = self.get_preprocessed_shape(len(frames), *frames.shape[2:], scale)
+            frames = interpolate(frames.float(), size=(height, width), mode='bilinear', align_corners=False)
+            frames = frames.round_()
+        if self.backend.input_rgb:
+            frames = frames.flip(1)
+        return frames.permute(0, 2, 3, 1)
+
+    def detect(self, frames: np.ndarray, scale: Union[float, List[float]] = None) -> Tuple[List[np.array], List[np.array]]:
+        scales = np.broadcast_to(self.scale if scale is None else scale, len(frames))
+        bounding_box_batch, key_points_batch = self.backend.detect(frames, *self.get_face_sizes(*frames.shape[1:3]))
+        return unscale_batch(bounding_box_batch, scales), unscale_batch(key_points_batch, scales)
+
+    def detect_regions(self,
+                       frame: np.ndarray,
+                       bounding_boxes: np.ndarray,
+                       margin: float = 1.0,
+                       iou_threshold: float = 0.5) -> Tuple[np.array, np.array]:
+        """Detects the faces of a preprocessed frame only in the `get_regions` around `bounding_boxes`."""
+        height, width = frame.shape[:2]
+        regions = get_regions(np.asarray(bounding_boxes, dtype=np.float32) * self.scale, margin, height, width)
+        if len(regions) == 0:
+            return [], []
+        crops = np.stack([frame[top:bottom, left:right] for left, top, right, bottom in regions])
+        bounding_box_batch, key_points_batch = self.backend.detect(crops, *self.get_face_sizes(height, width))
+
+        bounding_boxes, key_points = [], []
+        for (left, top, _, _), region_bounding_boxes, region_key_points in zip(regions, bounding_box_batch,
+                                                                              key_points_batch):
+            if region_bounding_boxes is not None:
+                bounding_boxes.append(region_bounding_boxes + np.array([left, top, left, top], dtype=np.float32))
+                key_points.append(region_key_points + np.array([left, top], dtype=np.float32))
+        if len(bounding_boxes) == 0:
+            return [], []
+        bounding_boxes = np.concatenate(bounding_boxes).astype(np.float32)
+        key_points = np.concatenate(key_points).astype(np.float32)
+
+        keep = []
+        ious = iou_matrix(bounding_boxes, bounding_boxes)
+        for i in range(len(bounding_boxes)):
+            if all(ious[i, j] <= iou_threshold for j in keep):
+                keep.append(i)
+        return bounding_boxes[keep] / self.scale, key_points[keep] / self.scale
+
+    def __call__(self, frame_batch: List[np.array]) -> Tuple[List[np.array], List[np.array]]:
+        if self.tensor_preprocessing:
+            return self.detect(self.preprocess_tensor(frame_batch))
+        return self.detect(self.preprocess(frame_batch))
 
     def set_scale(self, scale: float):
         self.scale = scale
+
+    def close(self):
+        if isinstance(self.backend, ReplicaBackend):
+            self.backend.close()
+
+
+def unscale_batch(batch: List[np.array], scales: np.ndarray) -> List[np.array]:
+    """Divides the points of each frame by its scale."""
+    counts = [len(points) if points is not None else 0 for points in batch]
+    if sum(counts) == 0:
+        return [[] for _ in batch]
+    points = np.concatenate([points for points in batch if points is not None])
+    points = points / np.repeat(scales, counts).astype(points.dtype).reshape((-1,) + (1,) * (points.ndim - 1))
+    points_batch = np.split(points, np.cumsum(counts)[:-1])
+    return [points if count > 0 else [] for points, count in zip(points_batch, counts)]
@@ -1,28 +1,31 @@
-import json
 import time
 import random
+import itertools
+import multiprocessing
+from queue import Queue
 from pathlib import Path
-from typing import Union
+from typing import Iterable, List, Tuple, Union
+from threading import Thread
 
 import argh
 import tqdm
 import numpy as np
+import pandas as pd
 
 from utils import *
-from face_detector import FaceDetector
-from video_reader import BatchedVideoReader, VideoReader
-from tracker import Tracker
+from face_detector import MTCNN_MODELS, MODEL_CACHE, FaceDetector
+from video_reader import BatchedVideoReader, FFmpegVideoReader, ParallelVideoReader, VideoReader
+from tracker import Tracker, TracksWriter
+from pipeline import Pipeline, Stage
+from batch_size_cache import BatchSizeCache
+from detections import (FORMATS, detections_path, get_face_size_range, iter_detections, load_detections, load_metadata,
+                        save_detections)
+from shots import find_shots, get_shot_schedule, get_shot_times
 
 
-def get_detections(reader: BatchedVideoReader, detector: FaceDetector):
-    """Detects faces and its key points for each batch of frames."""
-    for frame_batch, timestamp_batch in reader.read_batch():
-        bounding_box_batch, key_points_batch = detector(frame_batch)
-        for frame, timestamp, bounding_box, key_points in zip(frame_batch,
-                                                              timestamp_batch,
-                                                              bounding_box_batch,
-                                                              key_points_batch):
-            yield frame, timestamp, bounding_box, key_points
+def random_frames(batch_size: int, width: int, height: int) -> np.ndarray:
+    """Random uint8 frames, drawn as bytes to avoid a float64 intermediate."""
+    return np.random.randint(0, 256, (batch_size, height, width, 3), dtype=np.uint8)
 
 
 def find_batch_size(width: int, height: int, detector: FaceDetector, max_batch_size: int = np.inf):
@@ -31,8 +34,7 @@ def find_batch_size(width: int, height: int, detector: FaceDetector, max_batch_s
     while True:
         batch_size = min(2 * batch_size, max_batch_size)
         try:
-            image = (255 * np.random.random((batch_size, width, height, 3))).astype(np.uint8)
-            detector(image)
+            detector(random_frames(batch_size, width, height))
         except (RuntimeError, MemoryError) as err:
             break
         else:
@@ -47,8 +49,7 @@ def find_batch_size(width: int, height: int, detector: FaceDetector, max_batch_s
     while upper_bound - lower_bound > 2:
         batch_size = (upper_bound + lower_bound) // 2
         try:
-            image = (256 * np.random.random((batch_size, width, height, 3))).astype(np.uint8)
-            detector(image)
+            detector(random_frames(batch_size, width, height))
         except RuntimeError as err:
             upper_bound = batch_size
         else:
@@ -56,50 +57,469 @@ def find_batch_size(width: int, height: int, detector: FaceDetector, max_batch_s
     return lower_bound
 
 
-def detect_faces_on_video(reader, detector):
-    # Get the time spent detecting and tracking boxes
+def get_batch_size(width: int,
+                   height: int,
+                   detector: FaceDetector,
+                   cache: BatchSizeCache = None,
+                   max_batch_size: int = np.inf) -> int:
+    """Batch size for the frame shape from the cache, probed when missing or capped."""
+    if detector.backend.fixed_batch_size:
+        return min(detector.backend.fixed_batch_size, max_batch_size)
+    batch_size = cache.get(width, height, detector) if cache is not None else None
+    if batch_size is None or (batch_size < max_batch_size and cache.is_capped(width, height, detector)):
+        batch_size = find_batch_size(width, height, detector, max_batch_size=max_batch_size)
+        if cache is not None:
+            cache.set(width, height, detector, batch_size, capped=batch_size >= max_batch_size)
+    return min(batch_size, max_batch_size)
+
+
+def glob_detections(folder: Path):
+    for detections_format in FORMATS:
+        yield from folder.glob(f'**/*.detections.{detections_format}')
+
+
+def tracks_path(folder: Path, name: str) -> Path:
+    return folder / f'{video_id(name)}.tracks.json'
+
+
+def create_reader(frame_rate: float, sampling: str = None, decode_workers: int = 0, decoder: str = 'opencv'):
+    if decoder == 'ffmpeg':
+        if sampling or decode_workers > 0:
+            raise ValueError('The ffmpeg decoder takes no --sampling nor --decode-workers')
+        return FFmpegVideoReader(frame_rate)
+    sampling = sampling or 'grab'
+    if decode_workers > 0:
+        return ParallelVideoReader(frame_rate, num_workers=decode_workers, sampling=sampling)
+    return BatchedVideoReader(frame_rate, sampling=sampling)
+
+
+def get_video_scale(width: int, height: int, frame_scale: float, max_frame_size: int = None) -> float:
+    if max_frame_size and max_frame_size < max(width, height):
+        return float(max_frame_size) / float(frame_scale * max(width, height))
+    return frame_scale
+
+
+def select_keyframes(batches: Iterable, keyframe_interval: int, content_threshold: float, min_shot_length: float):
+    """Adds the content descriptors, deltas and keyframe flags to each batch."""
+    prev_descriptor = None
+    since_keyframe = keyframe_interval
+    last_shot_timestamp = 0
+    for frame_batch, timestamp_batch in batches:
+        descriptors = get_content_descriptors(frame_batch)
+        content_deltas = get_content_deltas(descriptors, prev_descriptor)
+        prev_descriptor = descriptors[-1]
+        keyframes = np.zeros(len(frame_batch), dtype=bool)
+        for i, (timestamp, content_delta) in enumerate(zip(timestamp_batch, content_deltas)):
+            shot_transition = is_shot_transition(timestamp, content_delta, last_shot_timestamp, content_threshold,
+                                                 min_shot_length)
+            if shot_transition:
+                last_shot_timestamp = timestamp
+            if since_keyframe >= keyframe_interval or shot_transition:
+                keyframes[i] = True
+                since_keyframe = 0
+            since_keyframe += 1
+        yield frame_batch, timestamp_batch, descriptors, content_deltas, keyframes
+
+
+def detect_faces_on_video(reader: BatchedVideoReader,
+                          detector: FaceDetector,
+                          preprocess_workers: int = 1,
+                          inference_workers: int = 1,
+                          queue_size: int = 2,
+                          tracks_writer: TracksWriter = None,
+                          keyframe_interval: int = 1,
+                          content_threshold: float = 250.0,
+                          min_shot_length: float = 10.0,
+                          region_margin: float = None):
+    """Detects the faces of a video overlapping decoding, preprocessing, inference and output."""
+    skip_detections = keyframe_interval > 1
+    region_detection = skip_detections and region_margin is not None
+    region_tracker = None
+    if region_detection:
+        region_tracker = tracks_writer.tracker if tracks_writer is not None else \
+            Tracker(content_threshold, min_shot_length=min_shot_length)
+
+    # Preprocessed batches are written to buffers that return to the pool after the inference
+    buffer_pool = Queue()
+    for _ in range(queue_size + preprocess_workers + inference_workers):
+        buffer_pool.put(None)
+
+    # The part of the detector scale not applied by the reader
+    scale = detector.scale / reader.scale
+    # The optical flow of skipped frames runs on the preprocessed frames as numpy arrays
+    tensor_preprocessing = detector.tensor_preprocessing and not skip_detections
+
+    def preprocess(batch):
+        frame_batch, timestamp_batch, descriptors, content_deltas, keyframes = batch
+        height, width = frame_batch[0].shape[:2]
+        if tensor_preprocessing:
+            # The frames are stacked in the buffer before being scaled on the device
+            shape = (reader.batch_size, height, width, 3)
+        else:
+            shape = detector.get_preprocessed_shape(reader.batch_size, height, width, scale)
+        buffer = buffer_pool.get()
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+        if tensor_preprocessing:
+            frames = detector.preprocess_tensor(frame_batch, out=buffer, scale=scale)
+        else:
+            frames = detector.preprocess(frame_batch, out=buffer, scale=scale)
+        if descriptors is None:
+            # The delta of the first frame is against the previous batch, the output sets it
+            descriptors = get_content_descriptors(frame_batch)
+            content_deltas = get_content_deltas(descriptors)
+        grays = [None] * len(frames)
+        if skip_detections and not region_detection:
+            conversion = cv2.COLOR_RGB2GRAY if detector.backend.input_rgb else cv2.COLOR_BGR2GRAY
+            grays = [cv2.cvtColor(frame, conversion) for frame in frames]
+        return buffer, frames, timestamp_batch, descriptors, content_deltas, keyframes, grays
+
+    def inference(batch):
+        buffer, frames, timestamp_batch, descriptors, content_deltas, keyframes, grays = batch
+        # The frames detected by regions are kept once the buffer returns to the pool
+        region_frames = [None] * len(frames)
+        try:
+            if region_detection:
+                region_frames = [frame.copy() if not keyframe else None for frame, keyframe in zip(frames, keyframes)]
+            if keyframes is None:
+                bounding_box_batch, key_points_batch = detector.detect(frames)
+            else:
+                bounding_box_batch = [None] * len(frames)
+                key_points_batch = [None] * len(frames)
+                if keyframes.any():
+                    detected = detector.detect(frames[keyframes])
+                    for i, bounding_box, key_points in zip(np.flatnonzero(keyframes), *detected):
+                        bounding_box_batch[i] = bounding_box
+                        key_points_batch[i] = key_points
+        finally:
+            buffer_pool.put(buffer)
+        return (timestamp_batch, descriptors, content_deltas, bounding_box_batch, key_points_batch, grays,
+                region_frames)
+
+    pipeline = Pipeline([Stage('preprocess', preprocess, preprocess_workers),
+                         Stage('inference', inference, inference_workers)],
+                        maxsize=queue_size, source_name='decode', sink_name='output')
+
+    # Frames are released once preprocessed, the ring of the reader is capped by `max_ring_bytes`
+    reader.set_held_batches(queue_size + preprocess_workers + 1)
     reader.start()
     width, height = reader.get_shape()
     data = {
         'frame_rate': reader.frame_rate,
         'batch_size': reader.batch_size,
+        'backend': detector.backend_name,
+        'mtcnn_model': detector.mtcnn_model,
         'min_face_size': detector.min_face_size,
+        'max_face_size': detector.max_face_size,
+        'face_size_range': detector.face_size_range,
         'max_frame_size': detector.max_frame_size,
         'frame_scale': detector.scale,
+        'decode_scale': reader.scale,
         'width': width,
         'height': height,
         'video_length': reader.get_duration(),
+        'content_delta_version': CONTENT_DELTA_VERSION,
         'time': [],
         'content_delta': [],
         'bounding_box': [],
         'key_points': []
     }
+    if tracks_writer is not None:
+        tracks_writer.open()
+    elif region_detection:
+        region_tracker.reset()
     try:
         with tqdm.tqdm(total=int(reader.get_duration()), leave=False) as mini_loop:
             mini_loop.set_postfix(batch_size=reader.batch_size)
-            prev_descriptor = 0
+            prev_descriptor = None
+            prev_gray = prev_bounding_box = prev_key_points = None
+            num_keyframes = 0
+            if skip_detections:
+                batches = select_keyframes(reader.read_batch(), keyframe_interval, content_threshold,
+                                           min_shot_length)
+            else:
+                batches = ((frames, timestamps, None, None, None) for frames, timestamps in reader.read_batch())
             start_time = time.time()
-            for frame, timestamp, bounding_box, key_points in get_detections(reader, detector):
-                mini_loop.update(int(timestamp - mini_loop.n))
-
-                descriptor = get_content_descriptor(frame)
-                content_delta = get_content_descriptor_distance(descriptor, prev_descriptor)
-                prev_descriptor = descriptor
-
-                data['time'].append(timestamp)
-                data['content_delta'].append(content_delta)
-                data['bounding_box'].append(bounding_box)
-                data['key_points'].append(key_points)
+            for timestamp_batch, descriptor_batch, content_delta_batch, bounding_box_batch, key_points_batch, \
+                    gray_batch, region_frame_batch in pipeline.run(batches):
+                content_delta_batch[0] = get_content_deltas(descriptor_batch[:1], prev_descriptor)[0]
+                prev_descriptor = descriptor_batch[-1]
+                frame_items = zip(timestamp_batch, content_delta_batch, bounding_box_batch, key_points_batch,
+                                  gray_batch, region_frame_batch)
+                for timestamp, content_delta, bounding_box, key_points, gray, region_frame in frame_items:
+                    mini_loop.update(int(timestamp - mini_loop.n))
+
+                    if skip_detections:
+                        if bounding_box is None and region_detection:
+                            bounding_box, key_points = detector.detect_regions(
+                                region_frame, region_tracker.get_opened_bounding_boxes(), region_margin)
+                        elif bounding_box is None:
+                            bounding_box, key_points = propagate_faces(prev_gray, gray, prev_bounding_box,
+                                                                       prev_key_points, detector.scale)
+                        else:
+                            num_keyframes += 1
+                        prev_gray, prev_bounding_box, prev_key_points = gray, bounding_box, key_points
+
+                    data['time'].append(timestamp)
+                    data['content_delta'].append(float(content_delta))
+                    data['bounding_box'].append(bounding_box)
+                    data['key_points'].append(key_points)
+                    if tracks_writer is not None:
+                        tracks_writer.update(timestamp, content_delta, bounding_box, key_points)
+                    elif region_detection:
+                        region_tracker.update(timestamp, content_delta, bounding_box, key_points)
+                        region_tracker.pop_finished_tracks()
             end_time = time.time()
             data['detection_length'] = end_time - start_time
+            # Time spent waiting for decoded frames
+            data['read_wait_length'] = reader.wait_time
+            data['pipeline'] = pipeline.get_stats()
+            if skip_detections:
+                data['keyframe_interval'] = keyframe_interval
+                data['num_keyframes'] = num_keyframes
+            if region_detection:
+                data['region_margin'] = region_margin
+        if tracks_writer is not None:
+            tracks_writer.close()
     except RuntimeError as err:
         reader.clear_queue()
         raise err
     finally:
+        if tracks_writer is not None:
+            tracks_writer.abort()
         reader.stop()
     return data
 
 
+class VideoJob:
+    """A video decoded and preprocessed on its own thread for `detect_faces_on_videos`."""
+
+    def __init__(self,
+                 video_path: Path,
+                 reader: BatchedVideoReader,
+                 detector: FaceDetector,
+                 frame_queue: Queue,
+                 tracks_writer: TracksWriter = None):
+        self.video_path = video_path
+        self.reader = reader
+        self.detector = detector
+        self.frame_queue = frame_queue
+        self.tracks_writer = tracks_writer
+        self.scale = detector.scale
+        self.data = None
+        self.error = None
+        self.frames = None
+        self.start_time = 0
+        self.thread = None
+
+    def open(self, frame_scale: float):
+        self.reader.open(self.video_path)
+        width, height = self.reader.get_shape()
+        self.scale = get_video_scale(width, height, frame_scale, self.detector.max_frame_size)
+        self.data = {
+            'frame_rate': self.reader.frame_rate,
+            'batch_size': self.reader.batch_size,
+            'backend': self.detector.backend_name,
+            'mtcnn_model': self.detector.mtcnn_model,
+            'min_face_size': self.detector.min_face_size,
+            'max_face_size': self.detector.max_face_size,
+            'face_size_range': self.detector.face_size_range,
+            'max_frame_size': self.detector.max_frame_size,
+            'frame_scale': self.scale,
+            'width': width,
+            'height': height,
+            'video_length': self.reader.get_duration(),
+            'content_delta_version': CONTENT_DELTA_VERSION,
+            'time': [],
+            'content_delta': [],
+            'bounding_box': [],
+            'key_points': []
+        }
+
+    def start(self):
+        self.start_time = time.time()
+        if self.tracks_writer is not None:
+            self.tracks_writer.open()
+        self.reader.start()
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self):
+        """Sends (job, frame, timestamp, content_delta) items and a None frame at the end."""
+        prev_descriptor = None
+        slot = 0
+        try:
+            # The part of the scale not applied by the reader
+            scale = self.scale / self.reader.scale
+            for frame_batch, timestamp_batch in self.reader.read_batch():
+                descriptors = get_content_descriptors(frame_batch)
+                content_deltas = get_content_deltas(descriptors, prev_descriptor)
+                prev_descriptor = descriptors[-1]
+                for frame, timestamp, content_delta in zip(frame_batch, timestamp_batch, content_deltas):
+                    if self.error is not None:
+                        return
+                    height, width = frame.shape[:2]
+                    shape = self.detector.get_preprocessed_shape(self.frame_queue.maxsize + 2, height, width, scale)
+                    if self.frames is None or self.frames.shape != shape:
+                        self.frames = np.empty(shape, dtype=np.uint8)
+                    frames = self.detector.preprocess([frame], self.frames[slot:slot + 1], scale)
+                    slot = (slot + 1) % len(self.frames)
+                    self.frame_queue.put((self, frames[0], timestamp, content_delta))
+        except Exception as err:
+            self.error = err
+        finally:
+            self.frame_queue.put((self, None, None, None))
+
+    def add_detection(self, timestamp: float, content_delta: np.float32, bounding_box: np.ndarray,
+                      key_points: np.ndarray):
+        self.data['time'].append(timestamp)
+        self.data['content_delta'].append(float(content_delta))
+        self.data['bounding_box'].append(bounding_box)
+        self.data['key_points'].append(key_points)
+        if self.tracks_writer is not None:
+            self.tracks_writer.update(timestamp, content_delta, bounding_box, key_points)
+
+    def finish(self) -> dict:
+        self.reader.stop()
+        if self.tracks_writer is not None:
+            self.tracks_writer.close()
+        self.data['detection_length'] = time.time() - self.start_time
+        self.data['read_wait_length'] = self.reader.wait_time
+        self.data['decode_scale'] = self.reader.scale
+        return self.data
+
+    def abort(self):
+        self.reader.stop()
+        if self.tracks_writer is not None:
+            self.tracks_writer.abort()
+
+
+def detect_batch(detector: FaceDetector, items: List, frames: np.ndarray, loop: tqdm.tqdm) -> int:
+    """Detects a batch of (job, timestamp, content_delta) items, halving it on memory errors."""
+    scales = [job.scale for job, _, _ in items]
+    try:
+        bounding_box_batch, key_points_batch = detector.detect(frames, scales)
+    except RuntimeError as err:
+        if len(items) == 1:
+            items[0][0].error = err
+            return np.inf
+        loop.write(f'GPU Memory error with batch size {len(items)}, splitting the batch')
+        half = len(items) // 2
+        return min(detect_batch(detector, items[:half], frames[:half], loop),
+                   detect_batch(detector, items[half:], frames[half:], loop))
+    for (job, timestamp, content_delta), bounding_box, key_points in zip(items, bounding_box_batch,
+                                                                        key_points_batch):
+        if job.error is None:
+            job.add_detection(timestamp, content_delta, bounding_box, key_points)
+    return len(items)
+
+
+def detect_faces_on_videos(video_paths: List[Path],
+                           dst_folder: Path,
+                           detector: FaceDetector,
+                           main_loop: tqdm.tqdm,
+                           jobs: int,
+                           frame_rate: float,
+                           frame_scale: float,
+                           batch_size: int,
+                           max_batch_size: int,
+                           sampling: str,
+                           cache: BatchSizeCache = None,
+                           detections_format: str = 'json',
+                           tracks_folder: Path = None,
+                           decode_scale: bool = False,
+                           decoder: str = 'opencv',
+                           tracker: Tracker = None):
+    """Decodes `jobs` videos at once and detects their frames in shared batches."""
+    frame_queue = Queue(maxsize=2 * max(batch_size, 1))
+    pending_paths = iter(video_paths)
+    active_jobs = []
+    # Items waiting for a batch, their frames, the batch size and the (width, height, scale)
+    # by preprocessed shape
+    batches = {}
+    batch_frames = {}
+    batch_sizes = {}
+    shape_setups = {}
+
+    def run_batch(shape):
+        items = batches[shape]
+        supported_batch_size = detect_batch(detector, items, batch_frames[shape][:len(items)], main_loop)
+        items.clear()
+        if supported_batch_size < batch_sizes[shape]:
+            batch_sizes[shape] = supported_batch_size
+            if cache is not None:
+                width, height, scale = shape_setups[shape]
+                detector.set_scale(scale)
+                cache.shrink(width, height, detector, supported_batch_size)
+
+    def start_jobs():
+        while len(active_jobs) < jobs:
+            video_path = next(pending_paths, None)
+            if video_path is None:
+                return
+            tracks_writer = None
+            if tracks_folder is not None:
+                tracks_writer = TracksWriter(tracks_path(tracks_folder, video_path.name),
+                                             Tracker(**tracker.get_parameters()) if tracker else Tracker())
+            job = VideoJob(video_path, create_reader(frame_rate, sampling, decoder=decoder), detector, frame_queue,
+                           tracks_writer)
+            try:
+                job.open(frame_scale)
+            except (cv2.error, ZeroDivisionError) as err:
+                main_loop.write(f'Video "{video_path}" has errors.\n\n{str(err)}\n\n')
+                main_loop.update()
+                continue
+            if decode_scale:
+                job.reader.set_scale(job.scale)
+            job.start()
+            active_jobs.append(job)
+
+    start_jobs()
+    while active_jobs:
+        job, frame, timestamp, content_delta = frame_queue.get()
+
+        if frame is None:
+            # Detect the frames left of the video before writing its file
+            for shape, items in batches.items():
+                if job.error is None and any(item[0] is job for item in items):
+                    run_batch(shape)
+            if job.error is None:
+                data = job.finish()
+                save_detections(data, detections_path(dst_folder, job.video_path.stem, detections_format),
+                                NumpyEncoder)
+            else:
+                job.abort()
+                main_loop.write(f'Video "{job.video_path}" has errors.\n\n{str(job.error)}\n\n')
+            active_jobs.remove(job)
+            main_loop.set_description(job.video_path.name)
+            main_loop.update()
+            start_jobs()
+            continue
+
+        if job.error is not None:
+            # Frames left of a failed video
+            continue
+
+        shape = frame.shape
+        if shape not in batch_sizes:
+            width, height = job.reader.get_shape()
+            shape_setups[shape] = (width, height, job.scale)
+            if batch_size > 0:
+                batch_sizes[shape] = batch_size
+            else:
+                detector.set_scale(job.scale)
+                batch_sizes[shape] = get_batch_size(width, height, detector, cache, max_batch_size)
+            batch_frames[shape] = np.empty((batch_sizes[shape],) + shape, dtype=np.uint8)
+        job.data['batch_size'] = batch_sizes[shape]
+        items = batches.setdefault(shape, [])
+        # The slot of the frame in the ring of its job is free once copied
+        np.copyto(batch_frames[shape][len(items)], frame)
+        items.append((job, timestamp, content_delta))
+        if len(items) >= batch_sizes[shape]:
+            run_batch(shape)
+
+
 @argh.arg('src_folder', help='Source folder for the detections.')
 @argh.arg('dst_folder', help='Destination folder for the tracks.')
 @argh.arg('sample_size', help='Sample size.')
@@ -150,127 +570,404 @@ def get_max_batch_size(video_path: str,
 @argh.arg('--frame-rate', type=float, default=30.0, help='Frame rate to read videos.')
 @argh.arg('--batch-size', type=int, default=0, help='Batch size for the face detector.')
 @argh.arg('--min-face-size', type=int, default=20, help='Minimum size of a face required by the face detector.')
+@argh.arg('--max-face-size', type=int, help='Maximum size of a face searched by the face detector, 0 for no limit. '
+                                             'MTCNN skips the smaller levels of its image pyramid.')
+@argh.arg('--face-sizes-from', type=str, help='Folder of earlier detections whose face sizes, relative to the '
+                                               'frame size, narrow the sizes searched.')
+@argh.arg('--face-size-quantile', type=float, help='Share of the earlier faces left out at each end of the sizes.')
 @argh.arg('--max-frame-size', type=int, default=None, help='Max size for a frame.')
 @argh.arg('--frame-scale', type=float, default=1.0, help='Scaling factor for all frames.')
 @argh.arg('--use-cpu', action='store_true', help='Whether the face detector should use the CPU.')
 @argh.arg('-r', '--randomize', action='store_true', help='Randomize the order of files.')
 @argh.arg('--max-batch-size', type=int, default=1024, help='Maximum batch size.')
-@argh.arg('--max-retries', type=int, default=5, help='Maximum number of retries per video.')
+@argh.arg('--max-retries', type=int, help='Maximum number of retries per video, 5 by default.')
+@argh.arg('--sampling', choices=VideoReader.sampling_modes, help='How the opencv reader skips frames, grab by '
+                                                                  'default.')
+@argh.arg('--decode-workers', type=int, default=0, help='Number of decoding processes, 0 decodes on a thread.')
+@argh.arg('--decode-scale', action='store_true', help='Scale the frames as they are decoded, so full size frames '
+                                                       'are not queued. The content deltas use the scaled frames.')
+@argh.arg('--decoder', choices=('opencv', 'ffmpeg'), help='Video decoder, ffmpeg scales the frames itself and '
+                                                           'decodes on its own threads.')
+@argh.arg('--preprocess-workers', type=int, help='Number of preprocessing threads, 1 by default.')
+@argh.arg('--inference-workers', type=int, help='Number of threads running the face detector, 1 by default.')
+@argh.arg('--queue-size', type=int, help='Batches queued between pipeline stages, 2 by default.')
+@argh.arg('-j', '--jobs', type=int, default=1, help='Number of videos decoded at once, sharing the face detector. '
+                                                     'The frames are detected on this thread, without the options '
+                                                     'of the pipeline, retries nor replicas.')
+@argh.arg('--batch-size-cache', type=str, help='JSON file caching the batch sizes found, empty to disable.')
+@argh.arg('--detections-format', choices=FORMATS, help='File format of the detections.')
+@argh.arg('--tracks-folder', type=str, help='Folder where the faces are also tracked while detected, with '
+                                             '--content-threshold, --min-shot-length and the tracker options.')
+@argh.arg('--iou-threshold', type=float, help='Threshold of the tracker for the IOU overlap between '
+                                               'different-frame detections.')
+@argh.arg('--max-gap-length', type=float, help='Maximum gap in seconds of the tracker between corresponding '
+                                                'detections.')
+@argh.arg('--assignment', choices=tuple(Tracker.assignments), help='How the tracker assigns detections to tracks.')
+@argh.arg('--backend', choices=FaceDetector.backends, help='Face detection model.')
+@argh.arg('--model-path', type=str, help='Model file of the yunet backend.')
+@argh.arg('--num-threads', type=int, help='Threads of the yunet backend, 0 keeps the OpenCV default.')
+@argh.arg('--intra-op-threads', type=int, help='Threads torch runs an operation on, 0 keeps the default.')
+@argh.arg('--inter-op-threads', type=int, help='Threads torch runs independent operations on, 0 keeps the default.')
+@argh.arg('--mtcnn-model', choices=MTCNN_MODELS, help='MTCNN nets on the CPU: float, traced by TorchScript, or '
+                                                      'traced with the linear layers quantized to int8.')
+@argh.arg('--model-cache', type=str, help='Folder caching the traced MTCNN nets.')
+@argh.arg('--replicas', type=int, help='Number of detector processes, each pinned to its share of the CPUs and '
+                                        'running as many threads as it has CPUs unless set. 0 detects in this '
+                                        'process.')
+@argh.arg('--keyframe-interval', type=int, help='Frames between detections, the faces of the frames in between '
+                                                 'are followed by optical flow. 1 detects every frame.')
+@argh.arg('--content-threshold', type=float, help='Content delta above which a frame starts a shot, is detected, '
+                                                   'and ends the tracks.')
+@argh.arg('--min-shot-length', type=float, help='Minimum length of a shot for the detection skipping and the '
+                                                 'tracker.')
+@argh.arg('--region-margin', type=float, help='Detect the frames between keyframes only around the faces of the open '
+                                             'tracks, grown by this share of their size on each side, instead of '
+                                             'following the faces by optical flow.')
+@argh.arg('--min-frame-rate', type=float, help='Frame rate of the static shots, found by a first pass over the '
+                                              'video. The shots are recorded with the detections.')
+@argh.arg('--boundary-length', type=float, help='Seconds around the shot boundaries read at the full frame rate.')
+@argh.arg('--static-threshold', type=float, help='Mean content delta under which a shot is static.')
 def detect_faces(src_folder: str,
                  dst_folder: str,
                  frame_rate: float = 30.0,
                  batch_size: Union[int, str] = 'auto',
                  min_face_size: int = 20,
+                 max_face_size: int = 0,
+                 face_sizes_from: str = None,
+                 face_size_quantile: float = 0.005,
                  max_frame_size: int = None,
                  frame_scale: float = 1.0,
                  use_cpu: bool = False,
                  randomize: bool = False,
                  max_batch_size: int = 1024,
-                 max_retries: int = 5):
+                 max_retries: int = None,
+                 sampling: str = None,
+                 decode_workers: int = 0,
+                 decode_scale: bool = False,
+                 decoder: str = 'opencv',
+                 preprocess_workers: int = None,
+                 inference_workers: int = None,
+                 queue_size: int = None,
+                 jobs: int = 1,
+                 batch_size_cache: str = str(Path.home() / '.cache' / 'chiletv' / 'batch_sizes.json'),
+                 detections_format: str = 'json',
+                 tracks_folder: str = None,
+                 iou_threshold: float = 0.5,
+                 max_gap_length: float = 1.0,
+                 assignment: str = 'greedy',
+                 backend: str = 'mtcnn',
+                 model_path: str = None,
+                 num_threads: int = 0,
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 replicas: int = 0,
+                 mtcnn_model: str = 'float',
+                 model_cache: str = str(MODEL_CACHE),
+                 keyframe_interval: int = 1,
+                 content_threshold: float = 250.0,
+                 min_shot_length: float = 10.0,
+                 region_margin: float = None,
+                 min_frame_rate: float = None,
+                 boundary_length: float = 2.0,
+                 static_threshold: float = 50.0):
+    if jobs > 1 and (keyframe_interval > 1 or min_frame_rate):
+        raise ValueError('Detection skipping and adaptive frame rates need --jobs 1')
+    pipeline_options = (preprocess_workers, inference_workers, queue_size, max_retries)
+    if jobs > 1 and (decode_workers > 0 or replicas > 0 or any(option is not None for option in pipeline_options)):
+        raise ValueError('--decode-workers, --preprocess-workers, --inference-workers, --queue-size, --max-retries '
+                         'and --replicas need --jobs 1')
+    preprocess_workers = 1 if preprocess_workers is None else preprocess_workers
+    inference_workers = 1 if inference_workers is None else inference_workers
+    queue_size = 2 if queue_size is None else queue_size
+    max_retries = 5 if max_retries is None else max_retries
     src_folder = Path(src_folder)
     dst_folder = Path(dst_folder)
+    tracks_folder = Path(tracks_folder) if tracks_folder else None
 
     dst_folder.mkdir(exist_ok=True)
+    if tracks_folder is not None:
+        tracks_folder.mkdir(exist_ok=True)
 
     if src_folder.is_file():
         done_videos = []
         ongoing_videos = all_videos = [src_folder]
     else:
         all_videos = list(src_folder.glob('**/*.mp4'))
-        done_videos = set(video_id(v.name) for v in dst_folder.glob('**/*.detections.json'))
+        done_videos = set(video_id(v.name) for v in glob_detections(dst_folder))
         ongoing_videos = sorted([v for v in all_videos if video_id(v.name) not in done_videos])
         
     if randomize:
         random.shuffle(ongoing_videos)
 
-    detector = FaceDetector(min_face_size, max_frame_size, not use_cpu, frame_scale)
+    face_size_range = None
+    if face_sizes_from:
+        face_size_range = get_face_size_range(sorted(glob_detections(Path(face_sizes_from))), face_size_quantile)
+    detector = FaceDetector(min_face_size, max_frame_size, not use_cpu, frame_scale, backend, model_path, num_threads,
+                            max_face_size, face_size_range, intra_op_threads, inter_op_threads, replicas,
+                            mtcnn_model, model_cache)
+    # One batch in detection by replica
+    inference_workers = max(inference_workers, replicas)
+    cache = BatchSizeCache(batch_size_cache) if batch_size_cache else None
+    tracker = Tracker(content_threshold, iou_threshold, max_gap_length, min_shot_length, assignment)
+
+    reader = None
+    try:
+        if jobs > 1:
+            with tqdm.tqdm(total=len(all_videos), initial=len(done_videos)) as main_loop:
+                detect_faces_on_videos(ongoing_videos, dst_folder, detector, main_loop, jobs,
+                                       frame_rate, frame_scale, batch_size, max_batch_size, sampling, cache,
+                                       detections_format, tracks_folder, decode_scale, decoder, tracker)
+            return
+
+        # Shared by the videos, so the decoding processes are started once
+        reader = create_reader(frame_rate, sampling, decode_workers, decoder)
+        with tqdm.tqdm(ongoing_videos, total=len(all_videos), initial=len(done_videos)) as main_loop:
+            for video_path in main_loop:
+                main_loop.set_description(video_path.name)
+
+                video_batch_size = batch_size
+
+                try:
+                    reader.open(video_path)
+                    width, height = reader.get_shape()
+
+                    video_scale = get_video_scale(width, height, frame_scale, detector.max_frame_size)
+                    detector.set_scale(video_scale)
+                    reader_scale = video_scale if decode_scale else 1.0
+                    reader.set_scale(reader_scale)
+
+                    if video_batch_size <= 0:
+                        video_batch_size = get_batch_size(width, height, detector, cache, max_batch_size)
+
+                    shots = None
+                    if min_frame_rate:
+                        start_time = time.time()
+                        shots = find_shots(video_path, frame_rate, content_threshold, min_shot_length,
+                                           sampling or 'grab', reader_scale)
+                        shot_scan_length = time.time() - start_time
+                        reader.set_schedule(get_shot_schedule(shots, frame_rate, min_frame_rate, boundary_length,
+                                                              static_threshold))
+
+                    tracks_writer = None
+                    if tracks_folder is not None:
+                        tracks_writer = TracksWriter(tracks_path(tracks_folder, video_path.name), tracker,
+                                                     get_shot_times(shots))
+
+                    bz_frac = max(int(0.1 * video_batch_size), 1)
+                    for retry_num in range(max(1, max_retries)):
+                        reader.set_batch_size(video_batch_size - bz_frac * retry_num)
+                        try:
+                            data = detect_faces_on_video(reader, detector,
+                                                         preprocess_workers, inference_workers, queue_size,
+                                                         tracks_writer, keyframe_interval, content_threshold,
+                                                         min_shot_length, region_margin)
+                        except RuntimeError as err:
+                            message = 'Retry {}: GPU Memory error for video "{}" with batch size {}'
+                            main_loop.write(message.format(retry_num+1, video_path, reader.batch_size))
+                            # Remember the smaller batch size so the next videos of this shape start from it
+                            if batch_size <= 0 and cache is not None:
+                                cache.shrink(width, height, detector, max(1, reader.batch_size - bz_frac))
+                        else:
+                            if shots is not None:
+                                data['min_frame_rate'] = min_frame_rate
+                                data['shot_scan_length'] = shot_scan_length
+                                data['shots'] = shots
+                            # Write detection file
+                            save_detections(data, detections_path(dst_folder, video_path.stem, detections_format),
+                                            NumpyEncoder)
+                            break
+                except (cv2.error, ZeroDivisionError) as err:
+                    main_loop.write(f'Video "{video_path}"({reader.batch_size}) has errors.\n\n{str(err)}\n\n')
+                    continue
+    finally:
+        if reader is not None:
+            reader.close()
+        # Stops the detector replicas
+        detector.close()
 
-    with tqdm.tqdm(ongoing_videos, total=len(all_videos), initial=len(done_videos)) as main_loop:
-        for video_path in main_loop:
-            main_loop.set_description(video_path.name)
 
-            video_scale = frame_scale
-            video_batch_size = batch_size
+def has_legacy_deltas(metadata: dict) -> bool:
+    """Whether the content deltas were written before they were versioned."""
+    return 'content_delta_version' not in metadata
 
-            reader = BatchedVideoReader(frame_rate)
 
-            try:
-                reader.open(video_path)
-                width, height = reader.get_shape()
-
-                if detector.max_frame_size and detector.max_frame_size < max(width, height):
-                    video_scale = float(detector.max_frame_size) / float(frame_scale * max(width, height))
-
-                detector.set_scale(video_scale)
-
-                if video_batch_size <= 0:
-                    video_batch_size = find_batch_size(width, height, detector, max_batch_size=max_batch_size)
-
-                bz_frac = max(int(0.1 * video_batch_size), 1)
-                for retry_num in range(max(1, max_retries)):
-                    reader.set_batch_size(video_batch_size - bz_frac * retry_num)
-                    try:
-                        data = detect_faces_on_video(reader, detector)
-                    except RuntimeError as err:
-                        message = 'Retry {}: GPU Memory error for video "{}" with batch size {}'
-                        main_loop.write(message.format(retry_num+1, video_path, reader.batch_size))
-                    else:
-                        # Write detection file
-                        with (dst_folder / f'{video_path.stem}.detections.json').open('w', encoding='utf8') as wp:
-                            json.dump(data, wp, cls=NumpyEncoder)
-                        break
-            except (cv2.error, ZeroDivisionError) as err:
-                main_loop.write(f'Video "{video_path}"({reader.batch_size}) has errors.\n\n{str(err)}\n\n')
-                continue
+def legacy_message(detection_path: Path) -> str:
+    return f'Tracked "{detection_path}" with its legacy content deltas: a shot starts under ' \
+           f'{LEGACY_CONTENT_THRESHOLD}, detect its faces again for the content threshold.'
+
 
-            del reader
+def track_file(task: Tuple[Tracker, Path, Path]) -> Tuple[Path, bool]:
+    tracker, detection_path, tracks_path = task
+    metadata = load_metadata(detection_path)
+    legacy_deltas = has_legacy_deltas(metadata)
+    shot_times = get_shot_times(metadata.get('shots'))
+    with TracksWriter(tracks_path, tracker, shot_times, legacy_deltas) as writer:
+        for timestamp, content_delta, bounding_box, key_points in iter_detections(detection_path):
+            writer.update(timestamp, content_delta, bounding_box, key_points)
+    return detection_path, legacy_deltas
 
 
 @argh.arg('src_folder', help='Source folder for the detections.')
 @argh.arg('dst_folder', help='Destination folder for the tracks.')
-@argh.arg('--content-threshold', help='Threshold for the shot-transition detector.')
+@argh.arg('--content-threshold', help='Threshold for the shot-transition detector, unless the shots were '
+                                       'recorded with the detections.')
 @argh.arg('--iou-threshold', help='Threshold for the IOU overlap between different-frame detections.')
 @argh.arg('--max-gap-length', help='Maximum allowed gap in seconds between corresponding detections.')
 @argh.arg('--min-shot-length', help='Minimum duration in seconds for a valid track.')
+@argh.arg('--assignment', choices=tuple(Tracker.assignments), help='How detections are assigned to tracks.')
+@argh.arg('-j', '--jobs', type=int, help='Number of processes tracking videos at once.')
 def track_detections(src_folder: str,
                      dst_folder: str,
-                     content_threshold: float = 90.0,
+                     content_threshold: float = 250.0,
                      iou_threshold: float = 0.5,
                      max_gap_length: float = 1.0,
-                     min_shot_length: float = 10.0):
+                     min_shot_length: float = 10.0,
+                     assignment: str = 'greedy',
+                     jobs: int = 1):
     src_folder = Path(src_folder)
     dst_folder = Path(dst_folder)
 
     dst_folder.mkdir(exist_ok=True)
 
-    all_detections = list(src_folder.glob('**/*.detections.json'))
+    all_detections = list(glob_detections(src_folder))
     done_detections = set(video_id(v.name) for v in dst_folder.glob('**/*.tracks.json'))
-    ongoing_detections = [v for v in all_detections if video_id(v.name) not in done_detections]
+    ongoing_detections = sorted([v for v in all_detections if video_id(v.name) not in done_detections])
 
-    tracker = Tracker(content_threshold, iou_threshold, max_gap_length, min_shot_length)
+    tracker = Tracker(content_threshold, iou_threshold, max_gap_length, min_shot_length, assignment)
 
-    with tqdm.tqdm(sorted(ongoing_detections), total=len(all_detections), initial=len(done_detections)) as main_loop:
-        for detection_path in main_loop:
-            main_loop.set_description(video_id(detection_path.name))
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        # Longest videos first, so no worker is left with a long one at the end
+        ongoing_detections.sort(key=lambda v: v.stat().st_size, reverse=True)
 
-            with detection_path.open('r', encoding='utf8') as fp:
-                detection_data = json.load(fp)
+    # Each task gets its own copy of the tracker
+    tasks = [(tracker, v, tracks_path(dst_folder, v.name)) for v in ongoing_detections]
+    try:
+        with tqdm.tqdm(total=len(all_detections), initial=len(done_detections)) as main_loop:
+            for detection_path, legacy_deltas in pool.imap_unordered(track_file, tasks) if pool else \
+                    map(track_file, tasks):
+                main_loop.set_description(video_id(detection_path.name))
+                main_loop.update()
+                if legacy_deltas:
+                    main_loop.write(legacy_message(detection_path))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def sweep_file(task: Tuple[List[Tracker], Path]) -> Tuple[Path, List[np.ndarray], bool]:
+    trackers, detection_path = task
+    detections = load_detections(detection_path)
+    legacy_deltas = has_legacy_deltas(detections.metadata)
+    shot_times = get_shot_times(detections.metadata.get('shots'))
+    frames = list(detections)
+    track_lengths = []
+    for tracker in trackers:
+        tracker.reset(shot_times, legacy_deltas)
+        lengths = []
+        for timestamp, content_delta, bounding_box, key_points in frames:
+            tracker.update(timestamp, content_delta, bounding_box, key_points)
+            lengths.extend(t.start_time - t.end_time for t in tracker.pop_finished_tracks().values())
+        tracker.finish_all_tracks()
+        lengths.extend(t.start_time - t.end_time for t in tracker.pop_finished_tracks().values())
+        track_lengths.append(np.array(lengths))
+    return detection_path, track_lengths, legacy_deltas
+
+
+def get_length_stats(track_lengths: np.ndarray) -> dict:
+    if len(track_lengths) == 0:
+        return dict(mean_track_length=np.nan, median_track_length=np.nan,
+                    p90_track_length=np.nan, max_track_length=np.nan)
+    return dict(mean_track_length=np.mean(track_lengths),
+                median_track_length=np.median(track_lengths),
+                p90_track_length=np.percentile(track_lengths, 90),
+                max_track_length=np.max(track_lengths))
+
+
+@argh.arg('src_folder', help='Source folder for the detections.')
+@argh.arg('dst_folder', help='Destination folder for the summary tables.')
+@argh.arg('--content-threshold', nargs='+', type=float, help='Thresholds for the shot-transition detector, '
+                                                                'unless the shots were recorded with the detections.')
+@argh.arg('--iou-threshold', nargs='+', type=float, help='Thresholds for the IOU overlap between detections.')
+@argh.arg('--max-gap-length', nargs='+', type=float, help='Maximum gaps in seconds between detections.')
+@argh.arg('--min-shot-length', nargs='+', type=float, help='Minimum durations in seconds for a valid track.')
+@argh.arg('--assignment', nargs='+', choices=tuple(Tracker.assignments), help='Assignments of detections to tracks.')
+@argh.arg('-j', '--jobs', type=int, help='Number of processes tracking videos at once.')
+def sweep_tracker(src_folder: str,
+                  dst_folder: str,
+                  content_threshold: List[float] = (250.0,),
+                  iou_threshold: List[float] = (0.5,),
+                  max_gap_length: List[float] = (1.0,),
+                  min_shot_length: List[float] = (10.0,),
+                  assignment: List[str] = ('greedy',),
+                  jobs: int = 1):
+    """Writes the track counts and lengths of every combination of the tracker parameters."""
+    src_folder = Path(src_folder)
+    dst_folder = Path(dst_folder)
+
+    dst_folder.mkdir(exist_ok=True)
+
+    trackers = [Tracker(*args) for args in itertools.product(content_threshold, iou_threshold, max_gap_length,
+                                                              min_shot_length, assignment)]
+    detection_paths = sorted(glob_detections(src_folder), key=lambda v: v.stat().st_size, reverse=True)
+    tasks = [(trackers, v) for v in detection_paths]
 
-            detection_data = zip(detection_data['time'],
-                                 detection_data['content_delta'],
-                                 detection_data['bounding_box'],
-                                 detection_data['key_points'])
+    # Track lengths of all the videos for each configuration
+    config_lengths = [[] for _ in trackers]
+    video_rows = []
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        with tqdm.tqdm(total=len(tasks)) as main_loop:
+            for detection_path, track_lengths, legacy_deltas in pool.imap_unordered(sweep_file, tasks) if pool else \
+                    map(sweep_file, tasks):
+                name = video_id(detection_path.name)
+                main_loop.set_description(name)
+                main_loop.update()
+                if legacy_deltas:
+                    main_loop.write(legacy_message(detection_path))
+                for tracker, lengths, all_lengths in zip(trackers, track_lengths, config_lengths):
+                    all_lengths.append(lengths)
+                    video_rows.append(dict(video_id=name, **tracker.get_parameters(),
+                                           num_tracks=len(lengths), **get_length_stats(lengths)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    summary_rows = []
+    for tracker, all_lengths in zip(trackers, config_lengths):
+        lengths = np.concatenate(all_lengths) if all_lengths else np.zeros(0)
+        summary_rows.append(dict(**tracker.get_parameters(),
+                                 num_videos=len(all_lengths),
+                                 num_tracks=len(lengths),
+                                 tracks_per_video=len(lengths) / max(len(all_lengths), 1),
+                                 **get_length_stats(lengths)))
 
-            for timestamp, content_delta, bounding_box, key_points in detection_data:
-                tracker.update(timestamp, content_delta, bounding_box, key_points)
-            tracker.finish_all_tracks()
+    pd.DataFrame(video_rows).sort_values(['video_id'], kind='stable').to_csv(dst_folder / 'videos.csv', index=False)
+    summary = pd.DataFrame(summary_rows)
+    summary.to_csv(dst_folder / 'summary.csv', index=False)
+    print(summary.to_string(index=False))
 
-            # Write detection file
-            with (dst_folder / f'{video_id(detection_path.name)}.tracks.json').open('w', encoding='utf8') as wp:
-                json.dump(tracker.get_data(), wp, cls=NumpyEncoder)
 
-            tracker.reset()
+@argh.arg('src_folder', help='Source folder for the detections.')
+@argh.arg('dst_folder', help='Destination folder for the converted detections.')
+@argh.arg('detections_format', choices=FORMATS, help='File format to convert to.')
+def convert_detections(src_folder: str, dst_folder: str, detections_format: str):
+    """Converts the detection files between the JSON and the columnar NPZ formats."""
+    src_folder = Path(src_folder)
+    dst_folder = Path(dst_folder)
+
+    dst_folder.mkdir(exist_ok=True)
+
+    with tqdm.tqdm(sorted(glob_detections(src_folder))) as main_loop:
+        for detection_path in main_loop:
+            main_loop.set_description(video_id(detection_path.name))
+            save_detections(load_detections(detection_path),
+                            detections_path(dst_folder, video_id(detection_path.name), detections_format))
 
 
 if __name__ == "__main__":
-    argh.dispatch_commands([sample_videos, get_max_batch_size, detect_faces, track_detections])
+    argh.dispatch_commands([sample_videos, get_max_batch_size, detect_faces, track_detections, sweep_tracker,
+                            convert_detections])
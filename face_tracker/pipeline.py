@@ -0,0 +1,183 @@
+import time
+from queue import Empty, Full, Queue
+from threading import Thread, Lock
+from typing import Callable, Iterable, List
+
+
+class Stage:
+    """A step of a `Pipeline` run by `num_workers` threads on (index, value) pairs."""
+
+    def __init__(self, name: str, function: Callable, num_workers: int = 1):
+        self.name = name
+        self.function = function
+        self.num_workers = max(1, num_workers)
+        self.input_queue = None
+        self.output_queue = None
+        self.threads = []
+        self.lock = Lock()
+        self.running_workers = 0
+        self.num_items = 0
+        self.busy_time = 0.0
+        self.input_wait_time = 0.0
+        self.output_wait_time = 0.0
+
+    def get_stats(self, elapsed_time: float) -> dict:
+        return {
+            'num_workers': self.num_workers,
+            'num_items': self.num_items,
+            'busy_length': self.busy_time,
+            'input_wait_length': self.input_wait_time,
+            'output_wait_length': self.output_wait_time,
+            'utilisation': self.busy_time / (self.num_workers * elapsed_time) if elapsed_time > 0 else 0.0,
+        }
+
+
+class Pipeline:
+    """Runs the stages concurrently with bounded queues between them."""
+    poll_interval = 0.1
+
+    def __init__(self, stages: List[Stage], maxsize: int = 2, source_name: str = 'source', sink_name: str = 'sink'):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.queues = [Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]
+        # The source is the thread pulling from the iterable, the sink is the caller of `run`
+        self.source_stage = Stage(source_name, None)
+        self.sink_stage = Stage(sink_name, None)
+        self.stopped = False
+        self.error = None
+        self.elapsed_time = 0.0
+        for stage, input_queue, output_queue in zip(stages, self.queues[:-1], self.queues[1:]):
+            stage.input_queue = input_queue
+            stage.output_queue = output_queue
+
+    def put(self, queue: Queue, item) -> bool:
+        """Waits for room in the queue until the pipeline stops, returns whether the item was queued."""
+        while not self.stopped:
+            try:
+                queue.put(item, timeout=self.poll_interval)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(self, queue: Queue):
+        """Waits for an item of the queue until the pipeline stops, returns None once stopped."""
+        while not self.stopped:
+            try:
+                return queue.get(timeout=self.poll_interval)
+            except Empty:
+                pass
+        return None
+
+    def feed(self, items: Iterable):
+        stage = self.source_stage
+        try:
+            iterator = iter(items)
+            while not self.stopped:
+                start_time = time.time()
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stage.busy_time += time.time() - start_time
+                start_time = time.time()
+                self.put(self.queues[0], (stage.num_items, value))
+                stage.output_wait_time += time.time() - start_time
+                stage.num_items += 1
+        except Exception as err:
+            self.fail(err)
+        self.put(self.queues[0], None)
+
+    def work(self, stage: Stage):
+        while True:
+            start_time = time.time()
+            item = self.get(stage.input_queue)
+            with stage.lock:
+                stage.input_wait_time += time.time() - start_time
+
+            if self.stopped:
+                return
+
+            if item is None:
+                # Let the other workers of the stage see the end of the stream
+                self.put(stage.input_queue, None)
+                with stage.lock:
+                    stage.running_workers -= 1
+                    if stage.running_workers == 0:
+                        self.put(stage.output_queue, None)
+                return
+
+            index, value = item
+            start_time = time.time()
+            try:
+                value = stage.function(value)
+            except Exception as err:
+                self.fail(err)
+                continue
+            finally:
+                with stage.lock:
+                    stage.busy_time += time.time() - start_time
+                    stage.num_items += 1
+
+            start_time = time.time()
+            self.put(stage.output_queue, (index, value))
+            with stage.lock:
+                stage.output_wait_time += time.time() - start_time
+
+    def fail(self, err: Exception):
+        if self.error is None:
+            self.error = err
+        self.stop()
+
+    def stop(self):
+        # The workers blocked on a queue see it at their next poll
+        self.stopped = True
+
+    def start(self, items: Iterable):
+        self.stopped = False
+        self.error = None
+        threads = [Thread(target=self.feed, args=(items,))]
+        for stage in self.stages:
+            stage.running_workers = stage.num_workers
+            stage.threads = [Thread(target=self.work, args=(stage,)) for _ in range(stage.num_workers)]
+            threads.extend(stage.threads)
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def run(self, items: Iterable):
+        """Yields the outputs of the last stage in input order, raising the first stage error."""
+        start_time = time.time()
+        threads = self.start(items)
+        stage = self.sink_stage
+        pending = {}
+        next_index = 0
+        try:
+            while True:
+                wait_time = time.time()
+                item = self.get(self.queues[-1])
+                stage.input_wait_time += time.time() - wait_time
+                if item is None:
+                    break
+                index, value = item
+                pending[index] = value
+                while next_index in pending:
+                    busy_time = time.time()
+                    yield pending.pop(next_index)
+                    stage.busy_time += time.time() - busy_time
+                    stage.num_items += 1
+                    next_index += 1
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            self.elapsed_time = time.time() - start_time
+
+        if self.error is not None:
+            raise self.error
+
+    def get_stats(self) -> dict:
+        stages = [self.source_stage] + self.stages + [self.sink_stage]
+        return {stage.name: stage.get_stats(self.elapsed_time) for stage in stages}
@@ -0,0 +1,68 @@
+from typing import List
+
+import numpy as np
+
+from detections import Detections
+from tracker import Tracker
+from utils import iou
+
+
+class ReferenceTracker(Tracker):
+    """Tracker with the original scalar-IOU, repeated-argmax matching."""
+
+    def match_tracks(self, timestamp: float, bounding_box_list: List, key_points_list: List):
+        opened_tracks = list(self.opened_tracks)
+        len_opened_tracks = len(opened_tracks)
+        len_bounding_boxes = len(bounding_box_list)
+
+        opened_track_indices = set(range(len_opened_tracks))
+        new_bounding_boxes_indices = set(range(len_bounding_boxes))
+
+        iou_mat = np.zeros((len_opened_tracks, len_bounding_boxes), dtype=float)
+        for i in opened_track_indices:
+            for j in new_bounding_boxes_indices:
+                track_bounding_box = self.get_track_bounding_box(opened_tracks[i])
+                iou_mat[i, j] = iou(track_bounding_box, bounding_box_list[j])
+
+        while iou_mat.size != 0:
+            i, j = np.unravel_index(iou_mat.argmax(), iou_mat.shape)
+            if iou_mat[i, j] < self.iou_threshold:
+                break
+            self.update_track(opened_tracks[i], timestamp, bounding_box_list[j], key_points_list[j])
+            iou_mat[i, :] = -1
+            iou_mat[:, j] = -1
+            opened_track_indices.remove(i)
+            new_bounding_boxes_indices.remove(j)
+
+        for i in opened_track_indices:
+            self.update_track(opened_tracks[i], timestamp, None, None)
+
+        for j in new_bounding_boxes_indices:
+            self.update_track(self.add_new_track(), timestamp, bounding_box_list[j], key_points_list[j])
+
+
+def run_tracker(tracker: Tracker, detections: Detections) -> dict:
+    tracker.reset()
+    for timestamp, content_delta, bounding_box, key_points in detections:
+        tracker.update(timestamp, content_delta, bounding_box, key_points)
+    tracker.finish_all_tracks()
+    return tracker.get_data()
+
+
+def same_tracks(tracks_a: dict, tracks_b: dict) -> bool:
+    if tracks_a.keys() != tracks_b.keys():
+        return False
+    for track_id, track_a in tracks_a.items():
+        track_a, track_b = track_a.to_dict(), tracks_b[track_id].to_dict()
+        if track_a.keys() != track_b.keys():
+            return False
+        for key, value in track_a.items():
+            if isinstance(value, list):
+                if len(value) != len(track_b[key]):
+                    return False
+                for a, b in zip(value, track_b[key]):
+                    if (a is None) != (b is None) or (a is not None and not np.array_equal(a, b)):
+                        return False
+            elif value != track_b[key]:
+                return False
+    return True
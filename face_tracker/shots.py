@@ -0,0 +1,81 @@
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from utils import get_content_descriptors, get_content_deltas, is_shot_transition
+from video_reader import BatchedVideoReader
+
+
+def find_shots(video_path: Union[str, Path],
+               scan_rate: float,
+               content_threshold: float = 250.0,
+               min_shot_length: float = 10.0,
+               sampling: str = 'grab',
+               scale: float = 1.0,
+               batch_size: int = 32) -> List[dict]:
+    """Splits a video in shots with the content descriptors of frames read at `scan_rate`."""
+    reader = BatchedVideoReader(scan_rate, batch_size, sampling=sampling)
+    reader.set_scale(scale)
+    reader.open(video_path)
+    reader.start()
+    times = []
+    content_deltas = []
+    prev_descriptor = None
+    try:
+        for frame_batch, timestamp_batch in reader.read_batch():
+            descriptors = get_content_descriptors(frame_batch)
+            times.extend(timestamp_batch)
+            content_deltas.append(get_content_deltas(descriptors, prev_descriptor))
+            prev_descriptor = descriptors[-1]
+        duration = reader.get_duration()
+    finally:
+        reader.stop()
+        reader.close()
+
+    content_deltas = np.concatenate(content_deltas) if content_deltas else np.zeros(0, dtype=np.float32)
+    # Frames starting a shot, the first one always does
+    starts = [0]
+    last_shot_timestamp = 0
+    for i, (timestamp, content_delta) in enumerate(zip(times, content_deltas)):
+        if is_shot_transition(timestamp, content_delta, last_shot_timestamp, content_threshold, min_shot_length):
+            last_shot_timestamp = timestamp
+            if i > 0:
+                starts.append(i)
+
+    shots = []
+    for start, end in zip(starts, starts[1:] + [len(times)]):
+        # The delta of the first frame is against the previous shot
+        shot_deltas = content_deltas[start + 1:end]
+        shots.append({
+            'start_time': times[start] if start > 0 else 0.0,
+            'end_time': times[end] if end < len(times) else duration,
+            'num_frames': end - start,
+            'mean_content_delta': float(np.mean(shot_deltas)) if len(shot_deltas) > 0 else 0.0,
+            'max_content_delta': float(np.max(shot_deltas)) if len(shot_deltas) > 0 else 0.0,
+        })
+    return shots
+
+
+def get_shot_schedule(shots: List[dict],
+                      frame_rate: float,
+                      min_frame_rate: float,
+                      boundary_length: float = 2.0,
+                      static_threshold: float = 50.0) -> List[Tuple[float, float]]:
+    """(start_time, frame_rate) segments reading the static middles of shots at `min_frame_rate`."""
+    schedule = []
+    for shot in shots:
+        start_time, end_time = shot['start_time'], shot['end_time']
+        static = shot['mean_content_delta'] < static_threshold
+        shot['frame_rate'] = min_frame_rate if static else frame_rate
+        schedule.append((start_time, frame_rate))
+        if static and end_time - start_time > 2 * boundary_length:
+            schedule.append((start_time + boundary_length, min_frame_rate))
+            schedule.append((end_time - boundary_length, frame_rate))
+    return schedule
+
+
+def get_shot_times(shots: List[dict] = None) -> Union[List[float], None]:
+    if shots is None:
+        return None
+    return [shot['start_time'] for shot in shots]
@@ -0,0 +1,93 @@
+import io
+import json
+
+import numpy as np
+
+from detections import (Detections, _scan_fields, iter_detections, load_detections, load_metadata,
+                        save_detections)
+from utils import NumpyEncoder
+
+
+def random_data(num_frames: int = 50, seed: int = 0) -> dict:
+    """Detections as written by detect-faces, with metadata on both sides of the frame columns."""
+    rng = np.random.RandomState(seed)
+    data = {'frame_rate': 10.0, 'backend': 'mtcnn', 'face_size_range': None,
+            'note': 'a "quoted", {braced} [bracketed]: value',
+            'time': [], 'content_delta': [], 'bounding_box': [], 'key_points': []}
+    for frame_num in range(num_frames):
+        num_faces = rng.randint(0, 4)
+        data['time'].append(frame_num / 10 + 1e-9 * rng.uniform())
+        data['content_delta'].append(float(rng.uniform(0, 1000)))
+        data['bounding_box'].append(rng.uniform(0, 640, (num_faces, 4)).astype(np.float32))
+        data['key_points'].append(rng.uniform(0, 640, (num_faces, 5, 2)).astype(np.float32))
+    data['pipeline'] = {'decode': {'num_items': 5, 'utilisation': 0.5}}
+    data['shots'] = [[0.0, 2.5, 10.0], [2.5, 5.0, 80.0]]
+    return data
+
+
+def assert_same_frames(frames_a, frames_b):
+    frames_a, frames_b = list(frames_a), list(frames_b)
+    assert len(frames_a) == len(frames_b)
+    for frame_a, frame_b in zip(frames_a, frames_b):
+        for value_a, value_b in zip(frame_a, frame_b):
+            assert np.asarray(value_a).dtype == np.asarray(value_b).dtype
+            assert np.array_equal(value_a, value_b)
+
+
+def test_iter_detections_matches_json_load(tmp_path):
+    path = tmp_path / 'video.detections.json'
+    save_detections(random_data(), path, NumpyEncoder)
+    with path.open('r', encoding='utf8') as fp:
+        expected = Detections.from_dict(json.load(fp))
+
+    for chunk_size in (1, 7, 64, 2 ** 16):
+        assert_same_frames(iter_detections(path, chunk_size=chunk_size), expected)
+
+
+def test_scan_fields_reads_the_file_once():
+    class CountingBytesIO(io.BytesIO):
+        num_bytes = 0
+
+        def read(self, size=-1):
+            chunk = super().read(size)
+            self.num_bytes += len(chunk)
+            return chunk
+
+    data = random_data(num_frames=500)
+    text = json.dumps(data, cls=NumpyEncoder).encode('latin-1')
+    fp = CountingBytesIO(text)
+    metadata, offsets = _scan_fields(fp, 64)
+    assert sorted(offsets) == sorted(['time', 'content_delta', 'bounding_box', 'key_points'])
+    assert metadata == Detections.from_dict(data).metadata
+    assert fp.num_bytes < 1.5 * len(text)
+
+
+def test_load_metadata_follows_file_changes(tmp_path):
+    path = tmp_path / 'video.detections.json'
+    save_detections(random_data(), path, NumpyEncoder)
+    metadata = load_metadata(path)
+    metadata['frame_rate'] = 0.0
+    assert load_metadata(path)['frame_rate'] == 10.0
+
+    data = random_data(num_frames=80)
+    data['frame_rate'] = 5.0
+    save_detections(data, path, NumpyEncoder)
+    assert load_metadata(path)['frame_rate'] == 5.0
+    assert len(list(iter_detections(path))) == 80
+
+
+
+def test_detections_round_trip(tmp_path):
+    data = random_data()
+    expected = Detections.from_dict(data)
+    json_path = tmp_path / 'video.detections.json'
+    npz_path = tmp_path / 'video.detections.npz'
+    save_detections(data, json_path, NumpyEncoder)
+    save_detections(load_detections(json_path), npz_path)
+
+    for path in (json_path, npz_path):
+        detections = load_detections(path)
+        assert detections.metadata == expected.metadata
+        assert_same_frames(detections, expected)
+        assert_same_frames(iter_detections(path), expected)
+    assert Detections.load(npz_path).to_dict() == load_detections(json_path).to_dict()
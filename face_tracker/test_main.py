@@ -0,0 +1,42 @@
+import json
+
+from detections import detections_path, save_detections
+from main import track_detections
+from test_tracker import synthetic_detections
+from utils import CONTENT_DELTA_VERSION, LEGACY_CONTENT_THRESHOLD
+
+
+def test_parallel_tracking_matches_serial(tmp_path):
+    src_folder = tmp_path / 'detections'
+    src_folder.mkdir()
+    for seed, detections_format in enumerate(['json', 'npz', 'json', 'npz']):
+        detections = synthetic_detections(num_frames=200, seed=seed)
+        detections.metadata['content_delta_version'] = CONTENT_DELTA_VERSION
+        save_detections(detections, detections_path(src_folder, f'video{seed}', detections_format))
+
+    track_detections(str(src_folder), str(tmp_path / 'serial'), min_shot_length=2.0)
+    track_detections(str(src_folder), str(tmp_path / 'parallel'), min_shot_length=2.0, jobs=2)
+    serial = sorted((tmp_path / 'serial').iterdir())
+    parallel = sorted((tmp_path / 'parallel').iterdir())
+    assert [p.name for p in serial] == [p.name for p in parallel] == [f'video{i}.tracks.json' for i in range(4)]
+    for serial_path, parallel_path in zip(serial, parallel):
+        assert serial_path.read_text(encoding='utf8') == parallel_path.read_text(encoding='utf8')
+
+
+def test_legacy_deltas_are_tracked_with_the_legacy_rule(tmp_path):
+    src_folder = tmp_path / 'detections'
+    src_folder.mkdir()
+    detections = synthetic_detections(num_frames=200)
+    # Wrapped deltas, under the legacy threshold within a shot
+    detections.content_delta[:] = 200.0
+    detections.content_delta[100] = 10.0
+    save_detections(detections, detections_path(src_folder, 'video', 'npz'))
+
+    track_detections(str(src_folder), str(tmp_path / 'tracks'), min_shot_length=2.0)
+    with (tmp_path / 'tracks' / 'video.tracks.json').open('r', encoding='utf8') as fp:
+        data = json.load(fp)
+    assert data['legacy_deltas'] and data['content_threshold'] == LEGACY_CONTENT_THRESHOLD
+    # The tracks end at the shot transition of frame 100, and not at the deltas above the threshold
+    shot_time = float(detections.time[100])
+    assert all(track['start_time'] < shot_time or track['end_time'] >= shot_time for track in data['tracks'].values())
+    assert any(track['end_time'] >= shot_time for track in data['tracks'].values())
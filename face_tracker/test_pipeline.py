@@ -0,0 +1,57 @@
+import time
+import random
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+
+def sleepy(function):
+    def run(value):
+        # Random delays, so the workers finish out of order
+        time.sleep(random.uniform(0, 0.005))
+        return function(value)
+    return run
+
+
+def test_pipeline_keeps_input_order():
+    pipeline = Pipeline([Stage('double', sleepy(lambda x: 2 * x), 4),
+                         Stage('increment', sleepy(lambda x: x + 1), 3)], maxsize=2)
+
+    assert list(pipeline.run(range(200))) == [2 * x + 1 for x in range(200)]
+    stats = pipeline.get_stats()
+    assert stats['double']['num_items'] == stats['increment']['num_items'] == 200
+
+
+def test_pipeline_raises_stage_errors():
+    def fail(value):
+        if value == 30:
+            raise ValueError('stage failed')
+        return value
+
+    pipeline = Pipeline([Stage('identity', sleepy(lambda x: x), 2), Stage('fail', fail, 3)], maxsize=1)
+    outputs = []
+    with pytest.raises(ValueError, match='stage failed'):
+        for value in pipeline.run(range(1000)):
+            outputs.append(value)
+    assert outputs == list(range(len(outputs)))
+    assert len(outputs) <= 30
+
+
+def test_pipeline_raises_source_errors():
+    def items():
+        yield from range(10)
+        raise KeyError('source failed')
+
+    pipeline = Pipeline([Stage('identity', lambda x: x, 2)])
+    with pytest.raises(KeyError):
+        list(pipeline.run(items()))
+
+
+def test_pipeline_stops_when_the_caller_does():
+    pipeline = Pipeline([Stage('identity', lambda x: x, 2)], maxsize=1)
+    outputs = pipeline.run(range(1000))
+    assert next(outputs) == 0
+    start_time = time.time()
+    outputs.close()
+    assert time.time() - start_time < 10 * Pipeline.poll_interval
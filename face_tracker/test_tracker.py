@@ -0,0 +1,128 @@
+import json
+
+import numpy as np
+import pytest
+
+from detections import Detections
+from reference_tracker import ReferenceTracker, run_tracker, same_tracks
+from tracker import Tracker, TracksWriter, greedy_assignment, hungarian_assignment
+
+
+def synthetic_detections(num_frames: int = 300, num_faces: int = 6, seed: int = 0) -> Detections:
+    """Faces drifting across a 640x360 frame, missed at times, with close neighbours and false detections."""
+    rng = np.random.RandomState(seed)
+    centres = rng.uniform([40, 40], [600, 320], (num_faces, 2))
+    sizes = rng.uniform(20, 80, num_faces)
+    data = {'time': [], 'content_delta': [], 'bounding_box': [], 'key_points': []}
+    for frame_num in range(num_frames):
+        centres += rng.normal(0, 4, centres.shape)
+        visible = rng.uniform(size=num_faces) > 0.15
+        boxes = [np.concatenate([centre - size / 2, centre + size / 2]) for centre, size, shown
+                 in zip(centres, sizes, visible) if shown]
+        # A second box on some faces, competing for the same track
+        boxes += [box + rng.normal(0, 3, 4) for box in boxes if rng.uniform() < 0.1]
+        if rng.uniform() < 0.2:
+            corner = rng.uniform([0, 0], [600, 320])
+            boxes.append(np.concatenate([corner, corner + rng.uniform(20, 60)]))
+        boxes = [boxes[i] for i in rng.permutation(len(boxes))]
+        data['time'].append(frame_num / 10)
+        # A cut now and then
+        data['content_delta'].append(1000.0 if frame_num % 97 == 96 else 50.0)
+        data['bounding_box'].append(boxes)
+        data['key_points'].append([np.tile(box[:2], (5, 1)) for box in boxes])
+    return Detections.from_dict(data)
+
+
+def test_greedy_assignment_matches_repeated_argmax():
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        # Few distinct values, so there are ties
+        iou_mat = rng.randint(0, 5, rng.randint(0, 6, 2)) / 4
+        pairs = greedy_assignment(iou_mat, 0.5)
+
+        expected = []
+        remaining = iou_mat.copy()
+        while remaining.size != 0:
+            i, j = np.unravel_index(remaining.argmax(), remaining.shape)
+            if remaining[i, j] < 0.5:
+                break
+            expected.append((i, j))
+            remaining[i, :] = -1
+            remaining[:, j] = -1
+        assert [(int(i), int(j)) for i, j in pairs] == [(int(i), int(j)) for i, j in expected]
+
+
+def best_total_iou(iou_mat: np.ndarray, iou_threshold: float, row: int = 0, used: frozenset = frozenset()) -> float:
+    """Greatest total iou of the pairs above threshold, by trying every assignment."""
+    if row == iou_mat.shape[0]:
+        return 0.0
+    best = best_total_iou(iou_mat, iou_threshold, row + 1, used)
+    for column in range(iou_mat.shape[1]):
+        if column not in used and iou_mat[row, column] >= iou_threshold:
+            best = max(best, iou_mat[row, column] + best_total_iou(iou_mat, iou_threshold, row + 1, used | {column}))
+    return best
+
+
+def test_hungarian_assignment_is_optimal():
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        iou_mat = rng.uniform(0, 1, rng.randint(0, 6, 2))
+        pairs = hungarian_assignment(iou_mat, 0.4)
+
+        rows = [i for i, _ in pairs]
+        columns = [j for _, j in pairs]
+        assert len(set(rows)) == len(rows) and len(set(columns)) == len(columns)
+        assert all(iou_mat[i, j] >= 0.4 for i, j in pairs)
+        assert np.isclose(sum(iou_mat[i, j] for i, j in pairs), best_total_iou(iou_mat, 0.4))
+
+
+def test_hungarian_assignment_matches_greedy_when_unambiguous():
+    rng = np.random.RandomState(1)
+    for _ in range(100):
+        num_rows, num_columns = rng.randint(1, 8, 2)
+        # At most one pair above threshold by row and by column
+        iou_mat = rng.uniform(0, 0.5, (num_rows, num_columns))
+        num_pairs = rng.randint(0, min(num_rows, num_columns) + 1)
+        iou_mat[rng.permutation(num_rows)[:num_pairs], rng.permutation(num_columns)[:num_pairs]] = \
+            rng.uniform(0.5, 1, num_pairs)
+
+        greedy = {(int(i), int(j)) for i, j in greedy_assignment(iou_mat, 0.5)}
+        hungarian = {(int(i), int(j)) for i, j in hungarian_assignment(iou_mat, 0.5)}
+        assert len(greedy) == num_pairs
+        assert hungarian == greedy
+
+
+def test_greedy_tracker_matches_reference_tracker():
+    for seed in range(3):
+        detections = synthetic_detections(seed=seed)
+        for iou_threshold in (0.3, 0.5):
+            args = (250.0, iou_threshold, 1.0, 2.0)
+            reference = run_tracker(ReferenceTracker(*args), detections)
+            greedy = run_tracker(Tracker(*args), detections)
+            assert len(greedy['tracks']) > 0
+            assert same_tracks(reference['tracks'], greedy['tracks'])
+
+
+def test_tracks_writer_matches_tracker(tmp_path):
+    detections = synthetic_detections()
+    expected = run_tracker(Tracker(250.0, 0.5, 1.0, 2.0), detections)
+    path = tmp_path / 'video.tracks.json'
+
+    with TracksWriter(path, Tracker(250.0, 0.5, 1.0, 2.0)) as writer:
+        for timestamp, content_delta, bounding_box, key_points in detections:
+            writer.update(timestamp, content_delta, bounding_box, key_points)
+    with path.open('r', encoding='utf8') as fp:
+        data = json.load(fp)
+    assert data == json.loads(json.dumps(expected, default=lambda obj: obj.to_dict()))
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
+
+
+def test_tracks_writer_leaves_no_file_on_errors(tmp_path):
+    path = tmp_path / 'video.tracks.json'
+    with pytest.raises(ValueError):
+        with TracksWriter(path, Tracker()) as writer:
+            for frame_num, frame in enumerate(synthetic_detections()):
+                writer.update(*frame)
+                if frame_num == 100:
+                    raise ValueError('detection failed')
+    assert list(tmp_path.iterdir()) == []
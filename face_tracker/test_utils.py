@@ -0,0 +1,31 @@
+import numpy as np
+
+from utils import get_content_deltas, get_content_descriptor, get_content_descriptor_distance, get_content_descriptors
+
+
+def test_content_delta_does_not_wrap_around():
+    # In uint8 arithmetic 0 - 255 wraps around to 1, and 255 - 0 squared to 1
+    descriptor_a = np.zeros(192, dtype=np.uint8)
+    descriptor_b = np.zeros(192, dtype=np.uint8)
+    descriptor_a[:2] = 255
+    descriptor_b[2:4] = 255
+
+    assert get_content_descriptor_distance(descriptor_a, descriptor_b) == 510.0
+    assert get_content_descriptor_distance(descriptor_b, descriptor_a) == 510.0
+    deltas = get_content_deltas(np.stack([descriptor_b, descriptor_a]), descriptor_a)
+    assert deltas.tolist() == [510.0, 510.0]
+
+
+def test_content_deltas_start_from_zeros():
+    descriptor = np.full(192, 255, dtype=np.uint8)
+    descriptor[4:] = 0
+
+    assert get_content_deltas(descriptor[None]).tolist() == [510.0]
+
+
+def test_content_descriptors_match_frame_descriptors():
+    frames = np.random.RandomState(0).randint(0, 256, (3, 48, 64, 3)).astype(np.uint8)
+
+    descriptors = get_content_descriptors(list(frames))
+    assert descriptors.dtype == np.uint8
+    assert np.array_equal(descriptors, np.stack([get_content_descriptor(frame) for frame in frames]))
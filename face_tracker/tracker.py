@@ -1,137 +1,328 @@
+import json
 import numpy as np
-from typing import List
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-from utils import iou
+from utils import LEGACY_CONTENT_THRESHOLD, iou_matrix, is_shot_transition
+
+
+def greedy_assignment(iou_mat: np.ndarray, iou_threshold: float) -> List[Tuple[int, int]]:
+    """Pairs (track, box) picked by repeatedly taking the greatest iou above threshold."""
+    matched_rows = np.zeros(iou_mat.shape[0], dtype=bool)
+    matched_columns = np.zeros(iou_mat.shape[1], dtype=bool)
+    pairs = []
+
+    # Visiting the pairs above threshold from the greatest iou, with ties in row-major order,
+    # picks the same pairs as repeatedly taking the argmax of the matrix
+    candidates = np.flatnonzero(iou_mat >= iou_threshold)
+    candidates = candidates[np.argsort(-iou_mat.flat[candidates], kind='stable')]
+    for i, j in zip(*np.unravel_index(candidates, iou_mat.shape)):
+        if matched_rows[i] or matched_columns[j]:
+            continue
+        pairs.append((i, j))
+        matched_rows[i] = True
+        matched_columns[j] = True
+    return pairs
+
+
+def hungarian_assignment(iou_mat: np.ndarray, iou_threshold: float) -> List[Tuple[int, int]]:
+    """Pairs (track, box) above threshold with the greatest total iou."""
+    num_rows, num_columns = iou_mat.shape
+    rows, columns = np.nonzero(iou_mat >= iou_threshold)
+    if len(rows) == 0:
+        return []
+
+    # Nodes 0..num_rows-1 are tracks, the rest are boxes
+    graph = coo_matrix((np.ones(len(rows)), (rows, columns + num_rows)), shape=(num_rows + num_columns,) * 2)
+    _, labels = connected_components(graph, directed=False)
+
+    pairs = []
+    for label in np.unique(labels[rows]):
+        component_rows = np.flatnonzero(labels[:num_rows] == label)
+        component_columns = np.flatnonzero(labels[num_rows:] == label)
+        if len(component_rows) == 1 and len(component_columns) == 1:
+            pairs.append((component_rows[0], component_columns[0]))
+            continue
+
+        # Pairs under threshold weigh nothing, so dropping them keeps the optimum
+        weights = iou_mat[np.ix_(component_rows, component_columns)]
+        weights = np.where(weights >= iou_threshold, weights, 0.0)
+        for i, j in zip(*linear_sum_assignment(weights, maximize=True)):
+            if weights[i, j] > 0:
+                pairs.append((component_rows[i], component_columns[j]))
+    return pairs
+
+
+class Track:
+    """Points of a track in growable arrays, with NaN rows for missed detections."""
+
+    __slots__ = ('time', 'bounding_box', 'key_points', 'size', 'last_frame', 'start_time', 'end_time')
+
+    def __init__(self, capacity: int = 16):
+        self.time = np.empty(capacity, dtype=np.float64)
+        self.bounding_box = np.empty((capacity, 4), dtype=np.float32)
+        self.key_points = np.empty((capacity, 5, 2), dtype=np.float32)
+        self.size = 0
+        self.last_frame = -1
+        self.start_time = None
+        self.end_time = None
+
+    def resize(self, capacity: int):
+        for name in ('time', 'bounding_box', 'key_points'):
+            column = getattr(self, name)
+            resized = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            resized[:self.size] = column[:self.size]
+            setattr(self, name, resized)
+
+    def append(self, frame: int, timestamp: float, bounding_box: List, key_points: List, gap_times: List[float]):
+        gap = len(gap_times)
+        if self.size + gap + 1 > len(self.time):
+            self.resize(max(2 * len(self.time), self.size + gap + 1))
+
+        if gap > 0:
+            self.time[self.size:self.size + gap] = gap_times
+            self.bounding_box[self.size:self.size + gap] = np.nan
+            self.key_points[self.size:self.size + gap] = np.nan
+            self.size += gap
+
+        self.time[self.size] = timestamp
+        self.bounding_box[self.size] = bounding_box
+        self.key_points[self.size] = np.nan if key_points is None else key_points
+        self.size += 1
+        self.last_frame = frame
+
+    def finish(self):
+        self.resize(self.size)
+        self.end_time = float(self.time[0])
+        self.start_time = float(self.time[self.size - 1])
+
+    def to_dict(self) -> dict:
+        detected = np.flatnonzero(~np.isnan(self.bounding_box[:self.size, 0]))
+        bounding_box = [None] * self.size
+        key_points = [None] * self.size
+        for i, box, points in zip(detected.tolist(),
+                                  self.bounding_box[detected].tolist(),
+                                  self.key_points[detected].tolist()):
+            bounding_box[i] = box
+            key_points[i] = points
+
+        data = dict(time=self.time[:self.size].tolist(),
+                    bounding_box=bounding_box,
+                    key_points=key_points,
+                    length=self.size)
+        if self.start_time is not None:
+            data['end_time'] = self.end_time
+            data['start_time'] = self.start_time
+            data['duration'] = self.start_time - self.end_time
+        return data
 
 
 class Tracker:
+    assignments = {
+        'greedy': greedy_assignment,
+        'hungarian': hungarian_assignment,
+    }
+
     def __init__(self,
-                 content_threshold: float,
-                 iou_threshold: float,
-                 max_gap_length: float,
-                 min_shot_length: float):
+                 content_threshold: float = 250.0,
+                 iou_threshold: float = 0.5,
+                 max_gap_length: float = 1.0,
+                 min_shot_length: float = 10.0,
+                 assignment: str = 'greedy'):
+        assert assignment in self.assignments, f'Unknown assignment "{assignment}"'
         self.content_threshold = content_threshold
         self.iou_threshold = iou_threshold
         self.max_gap_length = max_gap_length
         self.min_shot_length = min_shot_length
+        self.assignment = assignment
 
         self.tracks = {}
-        self.opened_tracks = []
+        # Opened tracks by id, in the order they were opened
+        self.opened_tracks = {}
+        # Ids of the tracks finished since the last `pop_finished_tracks`
+        self.finished_tracks = []
+        # Timestamps of the frames seen so far, to fill the gaps of the tracks
+        self.frame_times = []
         self.next_id = 0
         self.last_shot_timestamp = 0
+        # Start times of the shots recorded with the detections, replacing the content threshold
+        self.shot_times = None
+        self.next_shot = 0
+        # Content deltas of detection files without a version
+        self.legacy_deltas = False
 
-    def reset(self):
+    def reset(self, shot_times: List[float] = None, legacy_deltas: bool = False):
         self.tracks.clear()
         self.opened_tracks.clear()
+        self.finished_tracks.clear()
+        self.frame_times.clear()
         self.next_id = 0
         self.last_shot_timestamp = 0
+        self.shot_times = shot_times
+        self.next_shot = 0
+        self.legacy_deltas = legacy_deltas
 
     def add_new_track(self) -> int:
         track_id = self.next_id
         self.next_id += 1
 
-        self.tracks[track_id] = dict(time=[], bounding_box=[], key_points=[])
-        self.opened_tracks.append(track_id)
+        self.tracks[track_id] = self.opened_tracks[track_id] = Track()
         return track_id
 
     def update_track(self, track_id: int, timestamp: float, bounding_box: List, key_points: List):
-        self.tracks[track_id]['time'].append(timestamp)
-        self.tracks[track_id]['bounding_box'].append(bounding_box)
-        self.tracks[track_id]['key_points'].append(key_points)
+        # A missing detection is only written with the next detection of the track
+        if bounding_box is None:
+            return
+        track = self.tracks[track_id]
+        frame = len(self.frame_times) - 1
+        gap_times = self.frame_times[track.last_frame + 1:frame] if track.size > 0 else []
+        track.append(frame, timestamp, bounding_box, key_points, gap_times)
 
-        # Updates the index to the last non-None element added.
-        if bounding_box is not None:
-            self.tracks[track_id]['length'] = len(self.tracks[track_id]['bounding_box'])
+    def get_track_bounding_box(self, track_id: int) -> np.ndarray:
+        track = self.tracks[track_id]
+        return track.bounding_box[track.size - 1]
 
-    def get_track_bounding_box(self, track_id: int) -> List:
-        item_num = self.tracks[track_id]['length']
-        return self.tracks[track_id]['bounding_box'][item_num - 1]
+    def get_opened_bounding_boxes(self) -> np.ndarray:
+        bounding_boxes = [self.get_track_bounding_box(track_id) for track_id in self.opened_tracks]
+        return np.array(bounding_boxes, dtype=np.float32).reshape(-1, 4)
 
     def get_track_timestamp(self, track_id: int) -> float:
-        item_num = self.tracks[track_id]['length']
-        return self.tracks[track_id]['time'][item_num - 1]
+        track = self.tracks[track_id]
+        return track.time[track.size - 1]
 
     def finish_track(self, track_id: int):
-        item_num = self.tracks[track_id]['length']
-        end_time = self.tracks[track_id]['time'][0]
-        start_time = self.tracks[track_id]['time'][item_num - 1]
-
-        self.tracks[track_id]['time'] = self.tracks[track_id]['time'][:item_num]
-        self.tracks[track_id]['bounding_box'] = self.tracks[track_id]['bounding_box'][:item_num]
-        self.tracks[track_id]['key_points'] = self.tracks[track_id]['key_points'][:item_num]
-        self.tracks[track_id]['end_time'] = end_time
-        self.tracks[track_id]['start_time'] = start_time
-        self.tracks[track_id]['duration'] = start_time - end_time
-
-        self.opened_tracks.remove(track_id)
+        self.opened_tracks.pop(track_id).finish()
+        self.finished_tracks.append(track_id)
 
     def finish_all_tracks(self):
-        for track_id in self.opened_tracks:
+        for track_id in list(self.opened_tracks):
             self.finish_track(track_id)
 
-    def get_data(self):
-        data = {
+    def pop_finished_tracks(self) -> Dict[int, Track]:
+        """Removes the tracks finished since the last call and returns them."""
+        tracks = {track_id: self.tracks.pop(track_id) for track_id in self.finished_tracks}
+        self.finished_tracks.clear()
+        return tracks
+
+    def get_parameters(self) -> dict:
+        return {
             'content_threshold': self.content_threshold,
             'iou_threshold': self.iou_threshold,
             'max_gap_length': self.max_gap_length,
             'min_shot_length': self.min_shot_length,
-            'tracks': self.tracks.copy()
+            'assignment': self.assignment,
         }
+
+    def get_data(self):
+        data = self.get_parameters()
+        # The tracks are turned into lists by `to_dict` while they are written
+        data['tracks'] = dict(self.tracks)
         return data
 
     def close_tracks_by_gap(self, timestamp: float):
-        i = 0
-        while i < len(self.opened_tracks):
-            if timestamp - self.get_track_timestamp(self.opened_tracks[i]) > self.max_gap_length:
-                self.finish_track(self.opened_tracks[i])
-            else:
-                i += 1
+        for track_id, track in list(self.opened_tracks.items()):
+            if timestamp - track.time[track.size - 1] > self.max_gap_length:
+                self.finish_track(track_id)
 
     def close_by_shot_transition(self, timestamp: float, content_delta: float):
-        if content_delta < self.content_threshold and timestamp - self.last_shot_timestamp > self.min_shot_length:
+        if self.shot_times is not None:
+            # The first frame read from a shot may be slightly before its start time
+            next_shot = self.next_shot
+            while self.next_shot < len(self.shot_times) and self.shot_times[self.next_shot] - timestamp < 1e-3:
+                self.next_shot += 1
+            if self.next_shot > next_shot:
+                self.finish_all_tracks()
+                self.last_shot_timestamp = timestamp
+            return
+        if is_shot_transition(timestamp, content_delta, self.last_shot_timestamp, self.content_threshold,
+                              self.min_shot_length, self.legacy_deltas):
             self.finish_all_tracks()
             self.last_shot_timestamp = timestamp
 
     def match_tracks(self, timestamp: float, bounding_box_list: List, key_points_list: List):
-        len_opened_tracks = len(self.opened_tracks)
+        opened_tracks = list(self.opened_tracks)
         len_bounding_boxes = len(bounding_box_list)
 
-        opened_track_indices = set(range(len_opened_tracks))
-        new_bounding_boxes_indices = set(range(len_bounding_boxes))
+        matched_bounding_boxes = np.zeros(len_bounding_boxes, dtype=bool)
 
-        # Get the IOU for all pairs
-        iou_mat = np.zeros((len_opened_tracks, len_bounding_boxes), dtype=float)
-        for i in opened_track_indices:
-            for j in new_bounding_boxes_indices:
-                track_bounding_box = self.get_track_bounding_box(self.opened_tracks[i])
-                iou_mat[i, j] = iou(track_bounding_box, bounding_box_list[j])
+        if len(opened_tracks) > 0 and len_bounding_boxes > 0:
+            # Get the IOU for all pairs
+            track_bounding_boxes = np.array([self.get_track_bounding_box(track_id) for track_id in opened_tracks])
+            iou_mat = iou_matrix(track_bounding_boxes, bounding_box_list)
 
-        # Pick the detection with greatest iou
-        while iou_mat.size != 0:
-            i, j = np.unravel_index(iou_mat.argmax(), iou_mat.shape)
-
-            # Once the iou is bellow threshold then no valid detections are left
-            if iou_mat[i, j] < self.iou_threshold:
-                break
-
-            # Assign box i to track j
-            self.update_track(self.opened_tracks[i], timestamp, bounding_box_list[j], key_points_list[j])
-
-            # Remove the pair from the candidates
-            iou_mat[i, :] = -1
-            iou_mat[:, j] = -1
-            opened_track_indices.remove(i)
-            new_bounding_boxes_indices.remove(j)
-
-        # Add None for tracks with gaps
-        for i in opened_track_indices:
-            self.update_track(self.opened_tracks[i], timestamp, None, None)
+            for i, j in self.assignments[self.assignment](iou_mat, self.iou_threshold):
+                # Assign box j to track i
+                self.update_track(opened_tracks[i], timestamp, bounding_box_list[j], key_points_list[j])
+                matched_bounding_boxes[j] = True
 
         # Add new tracks
-        for j in new_bounding_boxes_indices:
+        for j in np.flatnonzero(~matched_bounding_boxes):
             self.update_track(self.add_new_track(), timestamp, bounding_box_list[j], key_points_list[j])
 
     def update(self, timestamp: float, content_delta: float, bounding_box_list: List, key_points_list: List):
+        self.frame_times.append(timestamp)
         self.close_by_shot_transition(timestamp, content_delta)
         self.match_tracks(timestamp, bounding_box_list, key_points_list)
         self.close_tracks_by_gap(timestamp)
+
+
+class TracksWriter:
+    """Writes the tracks of a video as they finish, to a file moved to `path` on `close`."""
+
+    def __init__(self, path: Union[str, Path], tracker: Tracker, shot_times: List[float] = None,
+                 legacy_deltas: bool = False):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        self.tracker = tracker
+        self.shot_times = shot_times
+        self.legacy_deltas = legacy_deltas
+        self.file = None
+        self.num_tracks = 0
+
+    def open(self) -> 'TracksWriter':
+        self.tracker.reset(self.shot_times, self.legacy_deltas)
+        self.num_tracks = 0
+        parameters = self.tracker.get_parameters()
+        if self.legacy_deltas:
+            parameters.update(content_threshold=LEGACY_CONTENT_THRESHOLD, legacy_deltas=True)
+        self.file = self.tmp_path.open('w', encoding='utf8')
+        self.file.write(json.dumps(parameters)[:-1] + ', "tracks": {')
+        return self
+
+    def write_tracks(self, tracks: Dict[int, Track]):
+        for track_id, track in tracks.items():
+            separator = ', ' if self.num_tracks > 0 else ''
+            self.file.write(f'{separator}"{track_id}": {json.dumps(track.to_dict())}')
+            self.num_tracks += 1
+
+    def update(self, timestamp: float, content_delta: float, bounding_box_list: List, key_points_list: List):
+        self.tracker.update(timestamp, content_delta, bounding_box_list, key_points_list)
+        self.write_tracks(self.tracker.pop_finished_tracks())
+
+    def close(self):
+        self.tracker.finish_all_tracks()
+        self.write_tracks(self.tracker.pop_finished_tracks())
+        self.file.write('}}')
+        self.file.close()
+        self.file = None
+        self.tmp_path.replace(self.path)
+        self.tracker.reset()
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.tmp_path.unlink()
+            self.tracker.reset()
+
+    def __enter__(self) -> 'TracksWriter':
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
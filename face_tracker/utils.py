@@ -3,12 +3,53 @@ import json
 import numpy as np
 
 
+# Version of the content descriptors and deltas written with the detections. Files without it hold
+# deltas of uint8 descriptor differences that wrapped around, taken for shot transitions below
+# the content threshold.
+CONTENT_DELTA_VERSION = 2
+# Content delta of those files under which a frame starts a shot
+LEGACY_CONTENT_THRESHOLD = 90.0
+
+
 def get_content_descriptor(frame, shape=(8, 8)):
     return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2HSV), shape, interpolation=cv2.INTER_AREA).flatten()
 
 
+def get_content_descriptors(frames, shape=(8, 8)) -> np.ndarray:
+    """Content descriptors of a batch of frames, one row per frame."""
+    descriptors = np.empty((len(frames), shape[0] * shape[1] * 3), dtype=np.uint8)
+    hsv = None
+    for descriptor, frame in zip(descriptors, frames):
+        # The HSV frame is reused while the frames keep their shape
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=hsv if hsv is not None and hsv.shape == frame.shape else None)
+        cv2.resize(hsv, shape, dst=descriptor.reshape(shape[1], shape[0], 3), interpolation=cv2.INTER_AREA)
+    return descriptors
+
+
 def get_content_descriptor_distance(descriptor_a, descriptor_b):
-    return np.sqrt(np.sum((descriptor_b - descriptor_a) ** 2))
+    # The descriptors are uint8, their difference would wrap around
+    difference = np.subtract(descriptor_b, descriptor_a, dtype=np.float32)
+    return np.sqrt(np.sum(difference ** 2))
+
+
+def get_content_deltas(descriptors: np.ndarray, prev_descriptor: np.ndarray = None) -> np.ndarray:
+    """Distances between consecutive descriptors, the first one to `prev_descriptor`."""
+    descriptors = np.asarray(descriptors, dtype=np.float32)
+    if prev_descriptor is None:
+        prev_descriptor = np.zeros(descriptors.shape[1:], dtype=np.float32)
+    differences = np.diff(np.concatenate([np.asarray(prev_descriptor, dtype=np.float32)[None], descriptors]), axis=0)
+    return np.sqrt(np.einsum('ij,ij->i', differences, differences))
+
+
+def is_shot_transition(timestamp: float,
+                       content_delta: float,
+                       last_shot_timestamp: float,
+                       content_threshold: float,
+                       min_shot_length: float,
+                       legacy_deltas: bool = False) -> bool:
+    if legacy_deltas:
+        return content_delta < LEGACY_CONTENT_THRESHOLD and timestamp - last_shot_timestamp > min_shot_length
+    return content_delta > content_threshold and timestamp - last_shot_timestamp > min_shot_length
 
 
 def remove_empty_detections(data, keep_ids):
@@ -40,6 +81,8 @@ class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
             return obj.tolist()
+        if hasattr(obj, 'to_dict'):
+            return obj.to_dict()
         return json.JSONEncoder.default(self, obj)
 
 
@@ -57,3 +100,99 @@ def iou(bbox_a: np.float32, bbox_b: np.float32) -> float:
     union_area = bbox_a_area + bbox_b_area - inter_area
 
     return inter_area / float(union_area)
+
+
+def iou_matrix(bboxes_a: np.ndarray, bboxes_b: np.ndarray) -> np.ndarray:
+    bboxes_a = np.asarray(bboxes_a)[:, None, :]
+    bboxes_b = np.asarray(bboxes_b)[None, :, :]
+
+    right = np.maximum(bboxes_a[..., 0], bboxes_b[..., 0])
+    top = np.maximum(bboxes_a[..., 1], bboxes_b[..., 1])
+    left = np.minimum(bboxes_a[..., 2], bboxes_b[..., 2])
+    bottom = np.minimum(bboxes_a[..., 3], bboxes_b[..., 3])
+
+    inter_area = np.maximum(0.0, left - right) * np.maximum(0.0, bottom - top)
+
+    bbox_a_area = (bboxes_a[..., 2] - bboxes_a[..., 0]) * (bboxes_a[..., 3] - bboxes_a[..., 1])
+    bbox_b_area = (bboxes_b[..., 2] - bboxes_b[..., 0]) * (bboxes_b[..., 3] - bboxes_b[..., 1])
+
+    union_area = bbox_a_area + bbox_b_area - inter_area
+
+    return inter_area / union_area
+
+
+def propagate_faces(prev_gray: np.ndarray,
+                    gray: np.ndarray,
+                    bounding_boxes: np.ndarray,
+                    key_points: np.ndarray,
+                    scale: float = 1.0,
+                    grid_size: int = 4):
+    """Moves the faces of the previous frame to the next one with the optical flow inside each box."""
+    if len(bounding_boxes) == 0:
+        return [], []
+    bounding_boxes = np.asarray(bounding_boxes, dtype=np.float32) * scale
+    key_points = np.asarray(key_points, dtype=np.float32).reshape(-1, 5, 2) * scale
+
+    steps = (np.arange(grid_size, dtype=np.float32) + 0.5) / grid_size
+    grid = np.stack(np.meshgrid(steps, steps), axis=-1).reshape(-1, 2)
+    sizes = bounding_boxes[:, 2:] - bounding_boxes[:, :2]
+    points = bounding_boxes[:, None, :2] + grid[None] * sizes[:, None]
+
+    moved_points, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points.reshape(-1, 1, 2), None,
+                                                       winSize=(15, 15), maxLevel=2)
+    moved_points = moved_points.reshape(points.shape)
+    status = status.reshape(points.shape[:2]).astype(bool)
+
+    moved_bounding_boxes = []
+    moved_key_points = []
+    for box, face_key_points, face_points, face_moved_points, tracked in zip(bounding_boxes, key_points, points,
+                                                                           moved_points, status):
+        if np.count_nonzero(tracked) < 2:
+            continue
+        old, new = face_points[tracked], face_moved_points[tracked]
+        old_centre, new_centre = np.median(old, axis=0), np.median(new, axis=0)
+        old_distances = np.linalg.norm(old - old_centre, axis=1)
+        new_distances = np.linalg.norm(new - new_centre, axis=1)
+        ratios = new_distances[old_distances > 0] / old_distances[old_distances > 0]
+        ratio = np.median(ratios) if len(ratios) > 0 else 1.0
+
+        moved_bounding_boxes.append((box.reshape(2, 2) - old_centre) * ratio + new_centre)
+        moved_key_points.append((face_key_points - old_centre) * ratio + new_centre)
+
+    if len(moved_bounding_boxes) == 0:
+        return [], []
+    return (np.array(moved_bounding_boxes, dtype=np.float32).reshape(-1, 4) / scale,
+            np.array(moved_key_points, dtype=np.float32) / scale)
+
+
+def get_regions(bounding_boxes: np.ndarray, margin: float, height: int, width: int) -> np.ndarray:
+    """Merged regions around `bounding_boxes`, all grown to the size of the largest one."""
+    bounding_boxes = np.asarray(bounding_boxes, dtype=np.float32).reshape(-1, 4)
+    sizes = bounding_boxes[:, 2:] - bounding_boxes[:, :2]
+    boxes = np.concatenate([bounding_boxes[:, :2] - margin * sizes, bounding_boxes[:, 2:] + margin * sizes], axis=1)
+    boxes = list(np.clip(boxes, 0, [width, height, width, height]))
+
+    regions = []
+    while boxes:
+        region = boxes.pop()
+        # Merging may make the region overlap boxes already checked
+        merged = True
+        while merged:
+            merged = False
+            for i in reversed(range(len(boxes))):
+                box = boxes[i]
+                if box[0] < region[2] and region[0] < box[2] and box[1] < region[3] and region[1] < box[3]:
+                    region = np.concatenate([np.minimum(region[:2], box[:2]), np.maximum(region[2:], box[2:])])
+                    del boxes[i]
+                    merged = True
+        regions.append(region)
+    if len(regions) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    regions = np.array(regions)
+    region_width = min(int(np.ceil(np.max(regions[:, 2] - regions[:, 0]))), width)
+    region_height = min(int(np.ceil(np.max(regions[:, 3] - regions[:, 1]))), height)
+    centres = (regions[:, :2] + regions[:, 2:]) / 2
+    left = np.clip(np.round(centres[:, 0] - region_width / 2), 0, width - region_width).astype(np.int64)
+    top = np.clip(np.round(centres[:, 1] - region_height / 2), 0, height - region_height).astype(np.int64)
+    return np.stack([left, top, left + region_width, top + region_height], axis=1)
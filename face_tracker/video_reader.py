@@ -1,19 +1,54 @@
+import math
 import time
+import bisect
+import subprocess
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import cv2
-from queue import Queue
-from typing import Tuple, Callable, Union
+import numpy as np
+from queue import Queue, Empty
+from typing import Tuple, Callable, Union, List
 from threading import Thread
 from pathlib import Path
 
 
+def get_frame_interval(ptime: float, frame_rate: float, schedule: List[Tuple[float, float]] = None) -> float:
+    """Time from the frame kept at `ptime` to the next one, following the `schedule` if any."""
+    if not schedule:
+        return 1.0 / frame_rate
+    i = bisect.bisect_right(schedule, (ptime, math.inf))
+    dtime = 1.0 / (schedule[i - 1][1] if i > 0 else frame_rate)
+    if i < len(schedule):
+        dtime = min(dtime, schedule[i][0] - ptime)
+    return dtime
+
+
 class VideoReader:
-    def __init__(self, frame_rate: float, transform: Callable = None, maxsize: int = 128):
+    """Reads frames from a video at a given frame rate on a background thread."""
+    sampling_modes = ('read', 'grab', 'seek')
+    # Largest ring preallocated, past it the frames are allocated as they are decoded
+    max_ring_bytes = 2 ** 30
+
+    def __init__(self,
+                 frame_rate: float,
+                 transform: Callable = None,
+                 maxsize: int = 128,
+                 sampling: str = 'grab',
+                 keyframe_interval: int = None):
+        assert sampling in self.sampling_modes, f'Unknown sampling mode "{sampling}"'
         self.frame_rate = frame_rate
         self.transform = transform
+        self.sampling = sampling
+        self.keyframe_interval = keyframe_interval
+        self.schedule = None
+        self.scale = 1.0
         self.stream = cv2.VideoCapture()
         self.frame_queue = Queue(maxsize=maxsize)
         self.stopped = False
         self.thread = None
+        self.wait_time = 0.0
+        self.frames = None
+        self.full_frame = None
         self._width = None
         self._height = None
         self._filename = None
@@ -34,11 +69,35 @@ class VideoReader:
         with self.frame_queue.mutex:
             self.frame_queue.queue.clear()
             self.frame_queue.all_tasks_done.notify_all()
+            self.frame_queue.not_full.notify_all()
             self.frame_queue.unfinished_tasks = 0
 
+    def get_ring_size(self) -> int:
+        """Frames alive at once: the queued ones, the one held by the consumer and the one being decoded."""
+        return self.frame_queue.maxsize + 2
+
+    def allocate_frames(self) -> np.ndarray:
+        """Preallocates the ring of frames, unless it would exceed `max_ring_bytes`."""
+        width, height = self.get_frame_shape()
+        shape = (self.get_ring_size(), height, width, 3)
+        if np.prod(shape) > self.max_ring_bytes:
+            self.frames = None
+        elif self.frames is None or self.frames.shape != shape:
+            self.frames = None
+            self.frames = np.empty(shape, dtype=np.uint8)
+        return self.frames
+
+    def get_frame(self, slot: int) -> np.ndarray:
+        if self.frames is not None:
+            return self.frames[slot % len(self.frames)]
+        width, height = self.get_frame_shape()
+        return np.empty((height, width, 3), dtype=np.uint8)
+
     def start(self):
-        self.stream.set(cv2.CAP_PROP_FPS, self.frame_rate)
         self.stopped = False
+        self.wait_time = 0.0
+        self.clear_queue()
+        self.allocate_frames()
         self.thread = Thread(target=self.update, args=())
         self.thread.daemon = True
         self.thread.start()
@@ -48,41 +107,105 @@ class VideoReader:
         self.stopped = True
         self._width = None
         self._height = None
-        self.thread.join()
+        # The producer may be blocked on a full queue
+        while self.thread is not None and self.thread.is_alive():
+            self.clear_queue()
+            self.thread.join(timeout=0.1)
+
+    def set_scale(self, scale: float):
+        self.scale = scale
+
+    def set_schedule(self, schedule: List[Tuple[float, float]]):
+        """Sets the (start_time, frame_rate) segments of the video, None reads it at `frame_rate`."""
+        self.schedule = schedule
 
     def read(self):
         frame, timestamp = self.frame_queue.get()
         assert frame is not None, "Frame is None"
         return frame, timestamp
 
+    def get_keyframe_interval(self) -> int:
+        """Number of frames that must be skipped before seeking is cheaper than grabbing."""
+        if self.keyframe_interval is None:
+            # Broadcast footage usually places a keyframe every one or two seconds
+            return int(2 * self.stream.get(cv2.CAP_PROP_FPS))
+        return self.keyframe_interval
+
+    def skip_to(self, timestamp: float, fps: float, keyframe_interval: int):
+        """Seeks to the frame right before `timestamp` if it lies beyond the next keyframe."""
+        position = int(self.stream.get(cv2.CAP_PROP_POS_FRAMES))
+        # The frame i has the timestamp i / fps. Stop one frame short, so the frame
+        # at `timestamp` is still selected by comparing timestamps.
+        target = int(math.ceil(timestamp * fps)) - 1
+        if target - position > keyframe_interval:
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, target)
+
+    def grab(self, keep: Callable[[float], bool], image: np.ndarray = None):
+        """Advances one frame, returns whether it succeeded, the frame if `keep` accepts it and its timestamp."""
+        # Scaled frames are first decoded into the single full size frame
+        decoded = image if self.scale == 1.0 else self.full_frame
+        if self.sampling == 'read':
+            ok, frame = self.stream.read(image=decoded)
+            stime = self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        else:
+            ok = self.stream.grab()
+            stime = self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            frame = None
+            if ok and keep(stime):
+                _, frame = self.stream.retrieve(image=decoded)
+        if frame is not None and self.scale != 1.0 and keep(stime):
+            # Same resize as `FaceDetector.preprocess`
+            frame = cv2.resize(frame, None, dst=image, fx=self.scale, fy=self.scale)
+        return ok, frame, stime
+
     def update(self):
         ptime = 0
-        dtime = 1.0 / self.frame_rate
-        self.stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        self.clear_queue()
-        while not self.stopped:
-            if not self.frame_queue.full():
-                ok, frame = self.stream.read()
-                stime = self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        slot = 0
+        end = None
+        try:
+            fps = self.stream.get(cv2.CAP_PROP_FPS)
+            keyframe_interval = self.get_keyframe_interval()
+            if self.scale != 1.0:
+                width, height = self.get_shape()
+                if self.full_frame is None or self.full_frame.shape != (height, width, 3):
+                    self.full_frame = np.empty((height, width, 3), dtype=np.uint8)
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            while not self.stopped:
+                dtime = get_frame_interval(ptime, self.frame_rate, self.schedule)
+                if self.sampling == 'seek':
+                    self.skip_to(ptime + dtime - 1e-3, fps, keyframe_interval)
+                # The slot is overwritten only after the whole ring has been handed over
+                ok, frame, stime = self.grab(lambda t: dtime - (t - ptime) < 1e-3, self.get_frame(slot))
                 if not ok:
-                    self.stopped = True
+                    break
                 if dtime - (stime - ptime) < 1e-3:
                     if self.transform:
                         frame = self.transform(frame)
                     self.frame_queue.put((frame, stime))
+                    slot += 1
                     ptime = stime
-            else:
-                time.sleep(0.1)
+        except Exception as err:
+            # Raised again by the consumer, so a partial stream is not taken for the whole video
+            end = err
+        finally:
+            # Marks the end of the stream
+            self.frame_queue.put(end)
+            self.stopped = True
 
     def more(self):
-        tries = 0
-        while self.frame_queue.qsize() == 0 and not self.stopped and tries < 5:
-            time.sleep(0.1)
-            tries += 1
-        return self.frame_queue.qsize() > 0
+        """Blocks until the next item is decoded and returns whether it is a frame."""
+        start_time = time.time()
+        with self.frame_queue.not_empty:
+            while len(self.frame_queue.queue) == 0:
+                self.frame_queue.not_empty.wait()
+            item = self.frame_queue.queue[0]
+        self.wait_time += time.time() - start_time
+        if isinstance(item, Exception):
+            raise item
+        return item is not None
 
     def running(self):
-        return self.more() or not self.stopped
+        return self.more()
 
     def get_shape(self, force: bool = False) -> Tuple[int, int]:
         if force or self._width is None or self._height is None:
@@ -90,14 +213,31 @@ class VideoReader:
             self._height = self.stream.get(cv2.CAP_PROP_FRAME_HEIGHT)
         return int(self._width), int(self._height)
 
+    def get_frame_shape(self) -> Tuple[int, int]:
+        width, height = self.get_shape()
+        if self.scale == 1.0:
+            return width, height
+        return int(round(width * self.scale)), int(round(height * self.scale))
+
     def get_duration(self) -> float:
         return self.stream.get(cv2.CAP_PROP_FRAME_COUNT) / self.stream.get(cv2.CAP_PROP_FPS)
 
 
 class BatchedVideoReader(VideoReader):
-    def __init__(self, frame_rate: float, batch_size: int = 1, transform: Callable = None, maxsize: int = 128):
-        super(BatchedVideoReader, self).__init__(frame_rate, transform, maxsize)
+    def __init__(self,
+                 frame_rate: float,
+                 batch_size: int = 1,
+                 transform: Callable = None,
+                 maxsize: int = 128,
+                 sampling: str = 'grab',
+                 keyframe_interval: int = None):
+        super(BatchedVideoReader, self).__init__(frame_rate, transform, maxsize, sampling, keyframe_interval)
         self.batch_size = batch_size
+        self.held_batches = 1
+
+    def get_ring_size(self) -> int:
+        # The consumer holds up to `held_batches` batches
+        return self.frame_queue.maxsize + self.batch_size * self.held_batches + 1
 
     def read_batch(self):
         frame_batch = []
@@ -113,3 +253,339 @@ class BatchedVideoReader(VideoReader):
 
     def set_batch_size(self, batch_size: int):
         self.batch_size = batch_size
+
+    def set_held_batches(self, held_batches: int):
+        """Sets how many yielded batches the consumer keeps before releasing their frames."""
+        self.held_batches = held_batches
+
+
+class FFmpegVideoReader(BatchedVideoReader):
+    """Decodes and scales the frames of a video with an ffmpeg process."""
+
+    def __init__(self,
+                 frame_rate: float,
+                 batch_size: int = 1,
+                 transform: Callable = None,
+                 maxsize: int = 128,
+                 ffmpeg_path: str = 'ffmpeg'):
+        super(FFmpegVideoReader, self).__init__(frame_rate, batch_size, transform, maxsize)
+        self.ffmpeg_path = ffmpeg_path
+
+    def get_command(self, fps: float) -> List[str]:
+        width, height = self.get_frame_shape()
+        filters = f'scale={width}:{height}:flags=area'
+        if not self.schedule:
+            ptime = f'if(isnan(prev_selected_n),0,prev_selected_n/{fps!r})'
+            filters = f"select='lt({1.0 / self.frame_rate!r}-(n/{fps!r}-{ptime}),0.001)'," + filters
+        return [self.ffmpeg_path, '-v', 'error', '-nostdin', '-i', self._filename, '-map', '0:v:0', '-vsync', '0',
+                '-vf', filters, '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:']
+
+    def update(self):
+        ptime = 0
+        index = 0
+        slot = 0
+        process = None
+        end = None
+        try:
+            fps = self.stream.get(cv2.CAP_PROP_FPS)
+            process = subprocess.Popen(self.get_command(fps), stdout=subprocess.PIPE, bufsize=0)
+            while not self.stopped:
+                stime = index / fps
+                index += 1
+                kept = get_frame_interval(ptime, self.frame_rate, self.schedule) - (stime - ptime) < 1e-3
+                if not kept and not self.schedule:
+                    # Dropped by ffmpeg
+                    continue
+                # Frames that are not kept are overwritten by the next one
+                frame = self.get_frame(slot)
+                if not read_exactly(process.stdout, memoryview(frame.reshape(-1))):
+                    if process.wait() != 0:
+                        raise cv2.error(f'ffmpeg exited with code {process.returncode} on "{self._filename}"')
+                    break
+                if kept:
+                    if self.transform:
+                        frame = self.transform(frame)
+                    self.frame_queue.put((frame, stime))
+                    slot += 1
+                    ptime = stime
+        except Exception as err:
+            # Raised again by the consumer, like in `VideoReader.update`
+            end = err
+        finally:
+            if process is not None:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+            # Marks the end of the stream
+            self.frame_queue.put(end)
+            self.stopped = True
+
+
+def read_exactly(stream, buffer: memoryview) -> bool:
+    """Fills the buffer from the stream, returns False if the stream ends first."""
+    offset = 0
+    while offset < len(buffer):
+        num_bytes = stream.readinto(buffer[offset:])
+        if not num_bytes:
+            return False
+        offset += num_bytes
+    return True
+
+
+def get_kept_frames(frame_count: int,
+                    fps: float,
+                    frame_rate: float,
+                    schedule: List[Tuple[float, float]] = None) -> List[int]:
+    """Indices of the frames kept by `VideoReader.update` on a constant frame rate video."""
+    ptime = 0
+    kept_frames = []
+    for i in range(frame_count):
+        stime = i / fps
+        dtime = get_frame_interval(ptime, frame_rate, schedule)
+        if dtime - (stime - ptime) < 1e-3:
+            kept_frames.append(i)
+            ptime = stime
+    return kept_frames
+
+
+# Last item of each task of a `decode_segments` worker
+TASK_END = 'end'
+
+
+def decode_task(reader: VideoReader,
+                generation: int,
+                frame_rate: float,
+                schedule: List[Tuple[float, float]],
+                sampling: str,
+                segments: List[Tuple[int, int, float]],
+                frames: np.ndarray,
+                free_slots: multiprocessing.Queue,
+                frame_queue: multiprocessing.Queue):
+    fps = reader.stream.get(cv2.CAP_PROP_FPS)
+    keyframe_interval = reader.get_keyframe_interval()
+    for start_frame, end_frame, ptime in segments:
+        if int(reader.stream.get(cv2.CAP_PROP_POS_FRAMES)) != start_frame:
+            reader.stream.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        while int(reader.stream.get(cv2.CAP_PROP_POS_FRAMES)) < end_frame:
+            dtime = get_frame_interval(ptime, frame_rate, schedule)
+            if sampling == 'seek':
+                reader.skip_to(ptime + dtime - 1e-3, fps, keyframe_interval)
+            ok, frame, stime = reader.grab(lambda t: dtime - (t - ptime) < 1e-3)
+            if not ok:
+                break
+            if dtime - (stime - ptime) < 1e-3:
+                # Slots freed during an earlier task are stale
+                slot_generation, slot = free_slots.get()
+                while slot_generation < generation:
+                    slot_generation, slot = free_slots.get()
+                if slot_generation > generation:
+                    # The next task started, its slot is put back
+                    free_slots.put((slot_generation, slot))
+                    return
+                if slot < 0:
+                    return
+                frames[slot] = frame
+                frame_queue.put((generation, (slot, stime)))
+                ptime = stime
+        frame_queue.put((generation, None))
+
+
+def decode_segments(buffer: RawArray,
+                    tasks: multiprocessing.Queue,
+                    free_slots: multiprocessing.Queue,
+                    frame_queue: multiprocessing.Queue):
+    """Worker of `ParallelVideoReader`, sends (generation, item) pairs for each task until a None task."""
+    for task in iter(tasks.get, None):
+        generation, filename, frame_rate, schedule, scale, sampling, keyframe_interval, segments, shape = task
+        frames = np.frombuffer(buffer, dtype=np.uint8, count=int(np.prod(shape))).reshape(shape)
+        reader = VideoReader(frame_rate, sampling=sampling, keyframe_interval=keyframe_interval)
+        reader.set_scale(scale)
+        try:
+            reader.open(filename)
+            decode_task(reader, generation, frame_rate, schedule, sampling, segments, frames, free_slots, frame_queue)
+        except Exception as err:
+            frame_queue.put((generation, (-1, f'{type(err).__name__}: {err}')))
+        finally:
+            reader.stream.release()
+            frame_queue.put((generation, TASK_END))
+
+
+class ParallelVideoReader(BatchedVideoReader):
+    """Decodes the videos in segments on worker processes kept alive until `close`."""
+
+    def __init__(self,
+                 frame_rate: float,
+                 batch_size: int = 1,
+                 transform: Callable = None,
+                 num_workers: int = None,
+                 segment_length: int = 32,
+                 sampling: str = 'grab',
+                 keyframe_interval: int = None):
+        super(ParallelVideoReader, self).__init__(frame_rate, batch_size, transform, 1, sampling, keyframe_interval)
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.segment_length = segment_length
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.tasks = []
+        self.free_slots = []
+        self.frame_queues = []
+        self.buffers = []
+        self.buffer_size = 0
+        self.frame_buffers = []
+        # The task of the video being read, and which workers have ended it
+        self.generation = 0
+        self.ended_tasks = []
+        self.num_segments = 0
+
+    def get_segments(self) -> List[Tuple[int, int, float]]:
+        fps = self.stream.get(cv2.CAP_PROP_FPS)
+        frame_count = int(self.stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        kept_frames = get_kept_frames(frame_count, fps, self.frame_rate, self.schedule)
+
+        segments = []
+        for i in range(0, len(kept_frames), self.segment_length):
+            start_frame = kept_frames[i]
+            end_frame = kept_frames[i + self.segment_length] if i + self.segment_length < len(kept_frames) \
+                else frame_count
+            ptime = kept_frames[i - 1] / fps if i > 0 else 0
+            segments.append((start_frame, end_frame, ptime))
+        return segments
+
+    def start_workers(self, buffer_size: int):
+        """Starts the workers unless they run with buffers of at least `buffer_size` bytes."""
+        if self.workers and buffer_size <= self.buffer_size:
+            return
+        self.stop_workers()
+        self.buffer_size = buffer_size
+        for _ in range(self.num_workers):
+            buffer = RawArray('B', buffer_size)
+            tasks = self.context.Queue()
+            free_slots = self.context.Queue()
+            frame_queue = self.context.Queue()
+            worker = self.context.Process(target=decode_segments, args=(buffer, tasks, free_slots, frame_queue))
+            worker.daemon = True
+            worker.start()
+
+            self.workers.append(worker)
+            self.tasks.append(tasks)
+            self.free_slots.append(free_slots)
+            self.frame_queues.append(frame_queue)
+            self.buffers.append(buffer)
+
+    def stop_workers(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for free_slots in self.free_slots:
+            free_slots.put((self.generation, -1))
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers.clear()
+        self.tasks.clear()
+        self.free_slots.clear()
+        self.frame_queues.clear()
+        self.buffers.clear()
+        self.buffer_size = 0
+
+    def start(self):
+        self.stopped = False
+        self.wait_time = 0.0
+        self.allocate_frames()
+        width, height = self.get_frame_shape()
+        shape = (self.segment_length, height, width, 3)
+        segments = self.get_segments()
+        self.num_segments = len(segments)
+        self.start_workers(int(np.prod(shape)))
+
+        self.generation += 1
+        self.ended_tasks = [False] * len(self.workers)
+        self.frame_buffers = []
+        for worker_num, (tasks, free_slots, buffer) in enumerate(zip(self.tasks, self.free_slots, self.buffers)):
+            for slot in range(self.segment_length):
+                free_slots.put((self.generation, slot))
+            tasks.put((self.generation, self._filename, self.frame_rate, self.schedule, self.scale, self.sampling,
+                       self.keyframe_interval, segments[worker_num::len(self.workers)], shape))
+            self.frame_buffers.append(np.frombuffer(buffer, dtype=np.uint8, count=int(np.prod(shape))).reshape(shape))
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self._width = None
+        self._height = None
+        for worker_num, free_slots in enumerate(self.free_slots):
+            if not self.ended_tasks[worker_num]:
+                free_slots.put((self.generation, -1))
+        try:
+            # Items left of the task
+            for worker_num in range(len(self.workers)):
+                while not self.ended_tasks[worker_num]:
+                    self.get_item(worker_num)
+        except cv2.error:
+            # A worker exited, the next video starts them again
+            self.stop_workers()
+
+    def close(self):
+        if not self.stopped:
+            self.stop()
+        self.stop_workers()
+        self.stream.release()
+
+    def get_ring_size(self) -> int:
+        return self.batch_size * self.held_batches + 1
+
+    def clear_queue(self):
+        pass
+
+    def get_item(self, worker_num: int):
+        """Next item of the current task, `TASK_END` once it is over."""
+        start_time = time.time()
+        while True:
+            try:
+                generation, item = self.frame_queues[worker_num].get(timeout=1.0)
+            except Empty:
+                if not self.workers[worker_num].is_alive():
+                    raise cv2.error(f'Decoding worker {worker_num} exited unexpectedly')
+            else:
+                if generation != self.generation:
+                    # Left of a stopped task
+                    continue
+                if item == TASK_END:
+                    self.ended_tasks[worker_num] = True
+                self.wait_time += time.time() - start_time
+                return item
+
+    def read_frames(self):
+        ring_slot = 0
+        for segment_num in range(self.num_segments):
+            worker_num = segment_num % len(self.workers)
+            while not self.stopped:
+                item = self.get_item(worker_num)
+                if item is None:
+                    break
+                if item == TASK_END:
+                    raise cv2.error(f'Decoding worker {worker_num} ended its segments early')
+                slot, timestamp = item
+                if slot < 0:
+                    raise cv2.error(timestamp)
+                frame = self.get_frame(ring_slot)
+                np.copyto(frame, self.frame_buffers[worker_num][slot])
+                self.free_slots[worker_num].put((self.generation, slot))
+                ring_slot += 1
+                if self.transform:
+                    frame = self.transform(frame)
+                yield frame, timestamp
+        self.stopped = True
+
+    def read_batch(self):
+        frame_batch = []
+        for frame, timestamp in self.read_frames():
+            frame_batch.append((frame, timestamp))
+
+            if len(frame_batch) >= self.batch_size:
+                yield tuple(zip(*frame_batch))
+                frame_batch.clear()
+
+        if len(frame_batch) > 0:
+            yield tuple(zip(*frame_batch))
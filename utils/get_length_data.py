@@ -4,7 +4,8 @@ from pathlib import Path
 
 import argh
 import pandas as pd
-from tqdm import tqdm
+
+from track_store import TrackStore
 
 
 def load_length_data(track_folders: List[Path]):
@@ -13,25 +14,26 @@ def load_length_data(track_folders: List[Path]):
         with (path / 'config.json').open('r', encoding='utf8') as fp:
             config_file = json.load(fp)
 
-        for track_file in path.glob('**/*.tracks.json'):
-            with track_file.open('r', encoding='utf8') as fp:
-                track_file = json.load(fp)
-            
-            for track in track_file['tracks'].values():
-                yield (
-                    track_file['url'][track_file['url'].rindex('=')+1:],
-                    track_file['video_duration'],
-                    track_file['width'],
-                    track_file['height'],
-                    track_file['detection_duration'],
-                    config_file['frame_rate'],
-                    config_file['content_threshold'],
-                    config_file['iou_threshold'],
-                    config_file['max_time_gap_length'],
-                    config_file['min_shot_length'],
-                    config_file['min_face_size'],
-                    config_file['detector_scale'],
-                    track['end_time'] - track['start_time'])
+        # Only the index of the store is read, the point columns are never mapped
+        store = TrackStore.open(path)
+        track_lengths = store.index['end_time'] - store.index['start_time']
+
+        for video_num, track_length in zip(store.index['video'], track_lengths):
+            video = store.videos[video_num]
+            yield (
+                video['url'][video['url'].rindex('=')+1:],
+                video['video_duration'],
+                video['width'],
+                video['height'],
+                video['detection_duration'],
+                config_file['frame_rate'],
+                config_file['content_threshold'],
+                config_file['iou_threshold'],
+                config_file['max_time_gap_length'],
+                config_file['min_shot_length'],
+                config_file['min_face_size'],
+                config_file['detector_scale'],
+                track_length)
 
 
 @argh.arg('save_path', help='Path to store the results.')
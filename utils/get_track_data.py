@@ -1,47 +1,36 @@
-import json
 import pickle
 from pathlib import Path
 
+import argh
 import numpy as np
-import pandas as pd
 
+from track_store import TrackStore
 
-def load_point_data(track_folder: Path):
-    data_time = []
-    data_bbox = []
-    data_tlen = []
-
-    for track_file in Path(track_folder).glob('**/*.tracks.json'):
-        with track_file.open('r', encoding='utf8') as fp:
-            track_file = json.load(fp)
 
-        # Ignore videos without tracks
-        if len(track_file['tracks']) == 0:
-            continue
-
-        track_time, track_bbox = zip(*[(t['time'], t['bbox']) for t in track_file['tracks'].values()])
+def load_point_data(track_folder: Path):
+    store = TrackStore.open(track_folder)
 
-        track_time = list(track_time)
-        track_bbox = list(track_bbox)
-        track_tlen = []
+    # Tracks are contiguous in the store, so every column is split at the same points
+    point_tracks = store.get_point_tracks()
+    starts = store.index['offset']
+    ends = starts + store.index['length']
+    split_points = ends[:-1]
 
-        for i, (t, b) in enumerate(zip(track_time, track_bbox)):        
-            # All tracks start from 0
-            t = np.float32(t) - t[0]
-            track_time[i] = t.tolist()
+    # All tracks start from 0
+    time = np.float32(store.time) - np.float32(store.time[starts])[point_tracks]
 
-            # Length of a track in seconds
-            track_tlen.append(t[-1])
+    # Length of a track in seconds
+    data_tlen = list(time[ends - 1])
 
-            # Box positions from screen center
-            b = np.float32(b).reshape(-1, 2, 2)
-            b[:, :, 0] -= 0.5 * track_file['width']
-            b[:, :, 1] -= 0.5 * track_file['height']
-            track_bbox[i] = b.tolist()
+    # Box positions from screen center
+    width = np.float32(store.get_video_field('width'))[point_tracks]
+    height = np.float32(store.get_video_field('height'))[point_tracks]
+    bbox = np.array(store.bounding_box, dtype=np.float32).reshape(-1, 2, 2)
+    bbox[:, :, 0] -= 0.5 * width[:, None]
+    bbox[:, :, 1] -= 0.5 * height[:, None]
 
-        data_time.extend(track_time)
-        data_bbox.extend(track_bbox)
-        data_tlen.extend(track_tlen)
+    data_time = [t.tolist() for t in np.split(time, split_points)] if len(store) else []
+    data_bbox = [b.tolist() for b in np.split(bbox, split_points)] if len(store) else []
     return data_time, data_bbox, data_tlen
 
 
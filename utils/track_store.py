@@ -0,0 +1,149 @@
+import json
+from pathlib import Path
+from typing import Iterable, List, Union
+
+import numpy as np
+
+
+class TrackStore:
+    """Tracks of a run packed into memory-mapped columns, rebuilt when the tracks files change."""
+
+    index_dtype = np.dtype([
+        ('video', np.int32),
+        ('track_id', np.int64),
+        ('start_time', np.float64),
+        ('end_time', np.float64),
+        ('offset', np.int64),
+        ('length', np.int64),
+    ])
+    columns = {
+        'time': (np.float64, ()),
+        'bounding_box': (np.float32, (4,)),
+        'key_points': (np.float32, (5, 2)),
+    }
+
+    def __init__(self, folder: Union[str, Path]):
+        self.folder = Path(folder)
+        with (self.folder / 'store.json').open('r', encoding='utf8') as fp:
+            self.description = json.load(fp)
+        self.videos = self.description['videos']
+        self.index = np.fromfile(str(self.folder / 'index.bin'), dtype=self.index_dtype)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            dtype, shape = self.columns[name]
+            num_points = self.description['num_points']
+            if num_points == 0:
+                self._columns[name] = np.zeros((0,) + shape, dtype=dtype)
+            else:
+                self._columns[name] = np.memmap(str(self.folder / f'{name}.bin'), dtype=dtype, mode='r',
+                                                shape=(num_points,) + shape)
+        return self._columns[name]
+
+    @property
+    def time(self) -> np.ndarray:
+        return self.column('time')
+
+    @property
+    def bounding_box(self) -> np.ndarray:
+        return self.column('bounding_box')
+
+    @property
+    def key_points(self) -> np.ndarray:
+        return self.column('key_points')
+
+    def get_track(self, track_num: int, name: str) -> np.ndarray:
+        offset, length = self.index['offset'][track_num], self.index['length'][track_num]
+        return self.column(name)[offset:offset + length]
+
+    def get_video_field(self, name: str) -> list:
+        """A scalar field of the tracks files, for each track."""
+        values = [video.get(name) for video in self.videos]
+        return [values[v] for v in self.index['video']]
+
+    def get_point_tracks(self) -> np.ndarray:
+        """Row of the index of each point."""
+        return np.repeat(np.arange(len(self.index)), self.index['length'])
+
+    @staticmethod
+    def get_sources(track_files: Iterable[Path]) -> List[list]:
+        """Absolute path, modification time and size of each tracks file."""
+        sources = []
+        for track_file in track_files:
+            stat = Path(track_file).stat()
+            sources.append([str(Path(track_file).resolve()), stat.st_mtime_ns, stat.st_size])
+        return sources
+
+    @classmethod
+    def build(cls, track_files: Iterable[Path], folder: Union[str, Path]) -> 'TrackStore':
+        """Packs the tracks files into a store, one file in memory at a time."""
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        # A store left half written is never opened
+        if (folder / 'store.json').exists():
+            (folder / 'store.json').unlink()
+        track_files = list(track_files)
+        # Taken before reading, so a file changed meanwhile is read again by the next `open`
+        sources = cls.get_sources(track_files)
+
+        videos = []
+        num_points = 0
+        column_files = {name: (folder / f'{name}.bin').open('wb') for name in cls.columns}
+        try:
+            with (folder / 'index.bin').open('wb') as index_file:
+                for track_file in track_files:
+                    with Path(track_file).open('r', encoding='utf8') as fp:
+                        data = json.load(fp)
+
+                    video = {key: value for key, value in data.items() if not isinstance(value, (list, dict))}
+                    video['video_id'] = Path(track_file).name[:Path(track_file).name.index('.')]
+                    videos.append(video)
+
+                    tracks = data['tracks']
+                    index = np.zeros(len(tracks), dtype=cls.index_dtype)
+                    for i, (track_id, track) in enumerate(tracks.items()):
+                        # Older tracks files name the boxes 'bbox'
+                        points = {
+                            'time': track['time'],
+                            'bounding_box': track.get('bounding_box', track.get('bbox')),
+                            'key_points': track.get('key_points', [None] * len(track['time'])),
+                        }
+                        for name, (dtype, shape) in cls.columns.items():
+                            values = points[name]
+                            if all(value is not None for value in values):
+                                column = np.asarray(values, dtype=dtype).reshape((len(values),) + shape)
+                            else:
+                                column = np.full((len(values),) + shape, np.nan, dtype=dtype)
+                                for j, value in enumerate(values):
+                                    if value is not None:
+                                        column[j] = value
+                            column_files[name].write(column.tobytes())
+
+                        index[i] = (len(videos) - 1, int(track_id), track.get('start_time', np.nan),
+                                    track.get('end_time', np.nan), num_points, len(track['time']))
+                        num_points += len(track['time'])
+                    index_file.write(index.tobytes())
+        finally:
+            for column_file in column_files.values():
+                column_file.close()
+
+        with (folder / 'store.json').open('w', encoding='utf8') as fp:
+            json.dump({'num_points': num_points, 'videos': videos, 'sources': sources}, fp)
+        return cls(folder)
+
+    @classmethod
+    def open(cls, track_folder: Union[str, Path], store_folder: Union[str, Path] = None) -> 'TrackStore':
+        """Opens the store of a folder, building it again when the tracks files changed."""
+        track_folder = Path(track_folder)
+        store_folder = Path(store_folder) if store_folder else track_folder / 'track_store'
+        track_files = sorted(track_folder.glob('**/*.tracks.json'))
+        if (store_folder / 'store.json').exists():
+            with (store_folder / 'store.json').open('r', encoding='utf8') as fp:
+                sources = json.load(fp).get('sources')
+            if sources == cls.get_sources(track_files):
+                return cls(store_folder)
+        return cls.build(track_files, store_folder)